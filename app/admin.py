@@ -0,0 +1,84 @@
+import asyncio
+import hmac
+import logging
+import threading
+from datetime import date
+
+from aiohttp import web
+from db_common import USAGE_ALL_CHATS
+from loop_monitor import LoopLagMonitor, format_folded, sample_stacks
+
+logger = logging.getLogger()
+
+
+class AdminHandler:
+    """Read-only admin routes, guarded by a bearer token."""
+
+    MAX_PROFILE_SECONDS = 60
+
+    def __init__(self, db: 'Database', handler: 'Handler', token: str, loop_monitor: LoopLagMonitor):  # type: ignore[valid-type]
+        self.db = db
+        self.handler = handler
+        self.token = token
+        self.loop_monitor = loop_monitor
+        self.profile_lock = asyncio.Lock()
+
+    def routes(self) -> list[web.RouteDef]:
+        return [
+            web.get('/admin/stats', self.handle_stats),
+            web.get('/admin/loop_lag', self.handle_loop_lag),
+            web.get('/admin/profile', self.handle_profile),
+        ]
+
+    def check_auth(self, request: web.Request):
+        expected = f"Bearer {self.token}"
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            logger.warning(f"Unauthorized admin request from {request.remote}")
+            raise web.HTTPUnauthorized()
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        """GET /admin/stats?day=YYYY-MM-DD&chat_id=<group id>; defaults to today across all chats."""
+        self.check_auth(request)
+        try:
+            day = date.fromisoformat(request.query.get('day', date.today().isoformat()))
+        except ValueError:
+            raise web.HTTPBadRequest(text="day must be YYYY-MM-DD")
+        chat_id = request.query.get('chat_id', USAGE_ALL_CHATS)
+
+        usage = await self.db.get_usage_stats(day, chat_id)
+        votes = usage['likes'] + usage['dislikes']
+        return web.json_response({
+            "day": day.isoformat(),
+            "chat_id": chat_id,
+            **usage,
+            "like_ratio": usage['likes'] / votes if votes else None,
+            "webhook_triage": dict(self.handler.triage_stats),
+            "admission": self.handler.admission.snapshot(),
+            "emojilm_tiers": dict(getattr(self.handler.emojilm, 'tier_stats', {})),
+            "sentence_cache": self.handler.emojilm.cache.stats(),
+            "lexicon": self.handler.emojilm.lexicon.stats() if self.handler.emojilm.lexicon is not None else None,
+            "near_duplicates": self.handler.emojilm.near_duplicates.stats()
+            if getattr(self.handler.emojilm, 'near_duplicates', None) is not None else None,
+        })
+
+    async def handle_loop_lag(self, request: web.Request) -> web.Response:
+        """GET /admin/loop_lag; the event loop scheduling delay histogram."""
+        self.check_auth(request)
+        return web.json_response(self.loop_monitor.stats())
+
+    async def handle_profile(self, request: web.Request) -> web.Response:
+        """GET /admin/profile?seconds=N; samples the event loop thread and returns folded stacks."""
+        self.check_auth(request)
+        try:
+            seconds = float(request.query.get('seconds', 10))
+        except ValueError:
+            raise web.HTTPBadRequest(text="seconds must be a number")
+        if not 0 < seconds <= self.MAX_PROFILE_SECONDS:
+            raise web.HTTPBadRequest(text=f"seconds must be in (0, {self.MAX_PROFILE_SECONDS}]")
+        if self.profile_lock.locked():
+            raise web.HTTPConflict(text="A profile is already running")
+
+        async with self.profile_lock:
+            logger.info(f"Profiling the event loop for {seconds}s")
+            samples = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds)
+        return web.Response(text=format_folded(samples), content_type='text/plain')
@@ -0,0 +1,131 @@
+'''
+Admission control in front of generation: token buckets per user and per group, weighted by
+the number of sentences a message will be split into, plus a global budget of sentences in flight.
+'''
+
+import re
+import time
+from collections import Counter, OrderedDict
+
+from segmentation import (CJK_CHARACTER_PATTERN, DEFAULT_MAX_CLAUSE_LENGTH,
+                          URL_PATTERN, coalesce_fragments, split_cjk)
+
+SHED_USER = "user"
+SHED_GROUP = "group"
+SHED_GLOBAL = "global"
+
+# Where the English sentence tokenizer can split: sentence-ending punctuation followed by whitespace
+SENTENCE_BOUNDARY_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+
+def estimate_sentence_count(input_text: str, min_clause_length: int = 0, max_clause_length: int = DEFAULT_MAX_CLAUSE_LENGTH) -> int:
+    """Cheap upper bound of the sentences `preprocess_input_text` produces, without language detection.
+
+    Text with any CJK character is counted as CJK fragments; other text by sentence-ending punctuation.
+    """
+    input_text = URL_PATTERN.sub("", input_text)
+    if not CJK_CHARACTER_PATTERN.search(input_text):
+        return max(1, sum(1 for sentence in SENTENCE_BOUNDARY_PATTERN.split(input_text.strip()) if sentence))
+
+    sentence_list, delimiter_list = split_cjk(input_text)
+    if min_clause_length:
+        sentence_list, delimiter_list = coalesce_fragments(
+            sentence_list, delimiter_list, min_clause_length, max_clause_length)
+    return max(1, sum(1 for sentence in sentence_list if sentence))
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, capacity: float, rate: float, now: float):
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class BucketTable:
+    """Token buckets keyed by chat id. Idle buckets are refilled anyway, so the oldest can be evicted."""
+
+    def __init__(self, capacity: float, rate: float, max_buckets: int):
+        self.capacity = capacity
+        self.rate = rate
+        self.max_buckets = max_buckets
+        self.buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def get(self, key: str, now: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.capacity, now)
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.refill(self.capacity, self.rate, now)
+        return bucket
+
+
+class AdmissionController:
+
+    def __init__(
+        self,
+        user_burst: float,
+        user_rate: float,
+        group_burst: float,
+        group_rate: float,
+        max_in_flight: int,
+        max_buckets: int = 10000,
+        degrade_in_flight: int = None,
+    ):
+        self.user_buckets = BucketTable(user_burst, user_rate, max_buckets)
+        self.group_buckets = BucketTable(group_burst, group_rate, max_buckets)
+        self.max_in_flight = max_in_flight
+        self.degrade_in_flight = degrade_in_flight
+        self.in_flight = 0
+        self.stats = Counter()
+
+    def try_admit(self, user_id: str, group_id: str, weight: int) -> str:
+        """Reserves `weight` sentences; returns None if admitted, else which limit shed the message.
+
+        Every admitted message must be given back with `release(weight)`.
+        """
+        if self.in_flight + weight > self.max_in_flight and self.in_flight > 0:
+            return self._shed(SHED_GLOBAL)
+
+        now = time.monotonic()
+        user_bucket = self.user_buckets.get(user_id, now)
+        # A message bigger than a full bucket is admitted when the bucket is full, and drains it
+        user_cost = min(weight, self.user_buckets.capacity)
+        if user_bucket.tokens < user_cost:
+            return self._shed(SHED_USER)
+
+        group_bucket = None
+        if group_id is not None:
+            group_bucket = self.group_buckets.get(group_id, now)
+            group_cost = min(weight, self.group_buckets.capacity)
+            if group_bucket.tokens < group_cost:
+                return self._shed(SHED_GROUP)
+            group_bucket.tokens -= group_cost
+
+        user_bucket.tokens -= user_cost
+        self.in_flight += weight
+        self.stats["admitted"] += 1
+        self.stats["admitted_sentences"] += weight
+        return None
+
+    def release(self, weight: int):
+        self.in_flight -= weight
+
+    def overloaded(self) -> bool:
+        """Whether admitted messages should be answered from the emoji lexicon only."""
+        return self.degrade_in_flight is not None and self.in_flight > self.degrade_in_flight
+
+    def _shed(self, reason: str) -> str:
+        self.stats[f"shed_{reason}"] += 1
+        return reason
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "in_flight_sentences": self.in_flight}
@@ -1,119 +1,197 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import atexit
 import logging
 import os
+import queue
 import sys
 from argparse import ArgumentParser
+from collections import Counter
 from datetime import datetime
+from logging.handlers import QueueListener
 from typing import Protocol
 from urllib.parse import parse_qsl
 
+import orjson
+from admin import AdminHandler
+from admission import AdmissionController, estimate_sentence_count
 from aiohttp import web
 from aiohttp.web_runner import TCPSite
+from emoji_lexicon import EmojiLexicon
 from emojilm_openai import EmojiLmOpenAi
+from feedback_compaction import database_maintenance_loop
 from linebot.v3 import WebhookParser, messaging
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (AsyncApiClient, AsyncMessagingApi,
                                   Configuration, QuickReply, QuickReplyItem,
                                   ReplyMessageRequest,
                                   ShowLoadingAnimationRequest, TextMessage)
-from linebot.v3.webhooks import (FollowEvent, JoinEvent, LeaveEvent,
+from linebot.v3.webhooks import (Event, FollowEvent, JoinEvent, LeaveEvent,
                                  MessageEvent, PostbackEvent,
                                  TextMessageContent, UnfollowEvent)
+from logging_utils import (LazyQueueHandler, SamplingFilter,
+                           create_rotating_file_handler)
+from loop_monitor import LoopLagMonitor
+from sentence_cache import SentenceCache
+from tracing import tracer
 
 logger = logging.getLogger()
 
 
 class EmojiLm(Protocol):
-    async def generate(self, input_text) -> tuple[str, set[str]]:
+    """What the handler and the admin routes use of a backend; EmojiLmBase provides all of it."""
+
+    min_clause_length: int
+    max_clause_length: int
+    cache: SentenceCache
+    lexicon: EmojiLexicon | None
+
+    async def generate(self, input_text, lexicon_only=False) -> tuple[str, set[str]]:
         ...
 
 
 class Handler:
     BOT_NAME = "哈哈狗"
+    MENTIONS = (f"@{BOT_NAME}", f"＠{BOT_NAME}")
 
     def __init__(
         self,
             line_bot_api: AsyncMessagingApi,
             parser: WebhookParser,
             emojilm: EmojiLm,
-            db: 'Database'  # type: ignore[valid-type] --- IGNORE ---,
+            db: 'Database',  # type: ignore[valid-type] --- IGNORE ---
+            admission: AdmissionController,
     ):
         self.line_bot_api = line_bot_api
         self.parser = parser
         self.emojilm = emojilm
         self.db = db
+        self.admission = admission
+        self.triage_stats = Counter()
 
     async def handle_callback(self, request):
         signature = request.headers['X-Line-Signature']
         body = await request.text()
 
-        try:
-            events = self.parser.parse(body, signature)
-        except InvalidSignatureError:
-            logger.error("Invalid signature.")
-            return web.Response(status=400, text='Invalid signature')
-
-        for event in events:
-            if isinstance(event, JoinEvent):
-                logger.info(f'加入群組 {event.source.group_id}')
-                await self.send_help_message(event)
-                await self.db.upsert_group(
-                    group_id=event.source.group_id,
-                    leave=False,
-                    first_use=datetime.fromtimestamp(event.timestamp/1000)
-                )
-            elif isinstance(event, FollowEvent):
-                logger.info(f'加入好友 {event.source.user_id}')
-            elif isinstance(event, LeaveEvent):
-                logger.warning(f'幹被踢了啦 {event.source.group_id}')
-                await self.db.upsert_group(
-                    group_id=event.source.group_id,
-                    leave=True
-                )
-            elif isinstance(event, UnfollowEvent):
-                logger.warning(f'幹被封鎖了啦 {event.source.user_id}')
-                await self.db.upsert_user(
-                    user_id=event.source.user_id,
-                    block=True,
-                    last_block=datetime.fromtimestamp(event.timestamp/1000)
+        # Each webhook request is one trace, triage included, so its trace id is the correlation id of its events
+        with tracer.span("webhook", body_length=len(body)) as request_span:
+            try:
+                with tracer.span("webhook.triage") as span:
+                    events = self.triage_events(body, signature)
+                    span.set_attribute("event_count", len(events))
+            except InvalidSignatureError:
+                logger.error("Invalid signature.")
+                request_span.set_attribute("invalid_signature", True)
+                return web.Response(status=400, text='Invalid signature')
+
+            for event in events:
+                with tracer.span("webhook_event", event_type=event.type, webhook_event_id=event.webhook_event_id):
+                    await self.handle_event(event)
+        return web.Response(text="OK\n")
+
+    async def handle_event(self, event: Event):
+        if isinstance(event, JoinEvent):
+            logger.info(f'加入群組 {event.source.group_id}')
+            await self.send_help_message(event)
+            await self.db.upsert_group(
+                group_id=event.source.group_id,
+                leave=False,
+                first_use=datetime.fromtimestamp(event.timestamp/1000)
+            )
+        elif isinstance(event, FollowEvent):
+            logger.info(f'加入好友 {event.source.user_id}')
+        elif isinstance(event, LeaveEvent):
+            logger.warning(f'幹被踢了啦 {event.source.group_id}')
+            await self.db.upsert_group(
+                group_id=event.source.group_id,
+                leave=True
+            )
+        elif isinstance(event, UnfollowEvent):
+            logger.warning(f'幹被封鎖了啦 {event.source.user_id}')
+            await self.db.upsert_user(
+                user_id=event.source.user_id,
+                block=True,
+                last_block=datetime.fromtimestamp(event.timestamp/1000)
+            )
+        elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+            try:
+                await asyncio.wait_for(
+                    self.handle_text_message(event),
+                    timeout=80
                 )
-            elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
-                try:
-                    await asyncio.wait_for(
-                        self.handle_text_message(event),
-                        timeout=80
-                    )
-                except asyncio.TimeoutError:
-                    logger.warning("Timeout")
-                    await self.line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[
-                                TextMessage(text="太多人用卡住了啦 去噴作者 sorry la 稍後再試")]
-                        )
+            except asyncio.TimeoutError:
+                logger.warning("Timeout (trace %s)", tracer.correlation_id())
+                await self.line_bot_api.reply_message(
+                    ReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[
+                            TextMessage(text="太多人用卡住了啦 去噴作者 sorry la 稍後再試")]
                     )
-                except messaging.exceptions.ApiException:
-                    logger.warning("API Exception")
-                    await self.line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[
-                                TextMessage(text="爛 Line 不給傳啦 可能太長了 sorry la 稍後再試")]
-                        )
+                )
+            except messaging.exceptions.ApiException:
+                logger.warning("API Exception")
+                await self.line_bot_api.reply_message(
+                    ReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[
+                            TextMessage(text="爛 Line 不給傳啦 可能太長了 sorry la 稍後再試")]
                     )
-                except Exception as e:
-                    logger.exception(e)
-                    await self.line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[
-                                TextMessage(text="服務暫時壞了 sorry la 稍後再試")]
-                        )
+                )
+            except Exception as e:
+                logger.exception(e)
+                await self.line_bot_api.reply_message(
+                    ReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[
+                            TextMessage(text="服務暫時壞了 sorry la 稍後再試")]
                     )
-            elif isinstance(event, PostbackEvent):
-                await self.handle_post_back(event)
-        return web.Response(text="OK\n")
+                )
+        elif isinstance(event, PostbackEvent):
+            await self.handle_post_back(event)
+
+    def triage_events(self, body: str, signature: str) -> list[Event]:
+        """Verifies the signature and builds event models only for events the bot acts on.
+
+        Group chats deliver every message to the webhook, so text messages that do not
+        mention the bot are dropped from the raw JSON before any pydantic model is built.
+        """
+        if not self.parser.signature_validator.validate(body, signature):
+            raise InvalidSignatureError(
+                f"Invalid signature. signature={signature}")
+
+        events = []
+        for raw_event in orjson.loads(body)['events']:
+            self.triage_stats['received'] += 1
+            if not self.is_relevant_event(raw_event):
+                self.triage_stats['dropped'] += 1
+                continue
+            try:
+                events.append(Event.from_dict(raw_event))
+            except ValueError:
+                # An event type newer than the SDK; the rest of the batch still has to be handled
+                logger.info(f"Unknown event type: {raw_event.get('type')}")
+                self.triage_stats['dropped'] += 1
+                self.triage_stats['dropped_unknown'] += 1
+
+        logger.debug("Triage: kept %d event(s), dropped %d/%d so far",
+                     len(events), self.triage_stats['dropped'], self.triage_stats['received'])
+        return events
+
+    def is_relevant_event(self, raw_event: dict) -> bool:
+        if raw_event.get('type') != 'message':
+            return True
+
+        message = raw_event.get('message') or {}
+        if message.get('type') != 'text':
+            self.triage_stats['dropped_non_text'] += 1
+            return False
+
+        text = message.get('text', '').strip()
+        if text == f"{self.BOT_NAME}幫幫我" or text.startswith(self.MENTIONS) or text.endswith(self.MENTIONS):
+            return True
+
+        self.triage_stats['dropped_no_mention'] += 1
+        return False
 
     async def send_help_message(self, event: MessageEvent):
         await self.line_bot_api.reply_message(
@@ -125,14 +203,9 @@ class Handler:
         )
 
     async def handle_text_message(self, event: MessageEvent):
-        logger.debug(f"Got message: {event.message.text}")
+        logger.debug("Got message: %s", event.message.text)
         input_text = event.message.text.strip()
 
-        await self.line_bot_api.show_loading_animation(
-            ShowLoadingAnimationRequest(
-                chatId=event.source.user_id, loadingSeconds=60)
-        )
-
         if input_text == f"{self.BOT_NAME}幫幫我":
             logger.info(f"幫幫我 by {event.source.user_id}")
             await self.send_help_message(event)
@@ -159,8 +232,40 @@ class Handler:
             )
             return
 
+        weight = estimate_sentence_count(
+            input_text, self.emojilm.min_clause_length, self.emojilm.max_clause_length)
+        group_id = event.source.group_id if event.source.type == "group" else None
+        shed_reason = self.admission.try_admit(event.source.user_id, group_id, weight)
+        if shed_reason is not None:
+            logger.warning("Shed %d-sentence message from user %s group %s: %s limit",
+                           weight, event.source.user_id, group_id, shed_reason)
+            await self.line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[
+                        TextMessage(text="太快了啦 慢一點 sorry la 稍後再試")]
+                )
+            )
+            return
+
+        lexicon_only = self.admission.overloaded()
+        if lexicon_only:
+            self.admission.stats["lexicon_only"] += 1
         try:
-            output_text_with_emoji, output_emoji_set = await self.emojilm.generate(input_text)
+            await self.reply_with_emoji(event, input_text, lexicon_only)
+        finally:
+            self.admission.release(weight)
+
+    async def reply_with_emoji(self, event: MessageEvent, input_text: str, lexicon_only: bool = False):
+        with tracer.span("line.show_loading_animation"):
+            await self.line_bot_api.show_loading_animation(
+                ShowLoadingAnimationRequest(
+                    chatId=event.source.user_id, loadingSeconds=60)
+            )
+
+        try:
+            with tracer.span("generate", input_length=len(input_text), lexicon_only=lexicon_only):
+                output_text_with_emoji, output_emoji_set = await self.emojilm.generate(input_text, lexicon_only=lexicon_only)
         except Exception as e:
             logger.exception(e)
             await self.line_bot_api.reply_message(
@@ -172,6 +277,17 @@ class Handler:
             )
             return
 
+        if lexicon_only and len(output_emoji_set) == 0:
+            # The lexicon covers none of it, so answer like a shed message
+            await self.line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[
+                        TextMessage(text="太快了啦 慢一點 sorry la 稍後再試")]
+                )
+            )
+            return
+
         if len(output_emoji_set) == 0:
             await self.line_bot_api.reply_message(
                 ReplyMessageRequest(
@@ -183,33 +299,33 @@ class Handler:
             return
 
         try:
-            try:
-                feedback_id = await asyncio.wait_for(
-                    self.db.insert_feedback(
-                        input_text=input_text,
-                        output_text=output_text_with_emoji,
-                        user_id=event.source.user_id,
-                        create_time=datetime.fromtimestamp(event.timestamp/1000)
-                    ),
-                    timeout=1
-                )
-            except asyncio.TimeoutError:
-                feedback_id = None
+            feedback_id = await asyncio.wait_for(self.db.allocate_feedback_id(), timeout=1)
         except (Exception, TimeoutError) as e:
-            logging.exception("Database insertion failed")
+            logging.exception("Feedback id allocation failed")
             feedback_id = None
 
-        await self.line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    TextMessage(
-                        text=output_text_with_emoji,
-                        quickReply=construct_quick_reply(feedback_id)
-                    )
-                ]
+        # Queued before replying, so a postback can always find the row
+        if feedback_id is not None:
+            await self.db.insert_feedback(
+                feedback_id=feedback_id,
+                input_text=input_text,
+                output_text=output_text_with_emoji,
+                user_id=event.source.user_id,
+                create_time=datetime.fromtimestamp(event.timestamp/1000)
+            )
+
+        with tracer.span("line.reply_message", output_length=len(output_text_with_emoji)):
+            await self.line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[
+                        TextMessage(
+                            text=output_text_with_emoji,
+                            quickReply=construct_quick_reply(feedback_id)
+                        )
+                    ]
+                )
             )
-        )
 
         if event.source.type == "group":
             await self.db.upsert_group(
@@ -243,7 +359,8 @@ class Handler:
                 f"Invalid feedback_id in postback data: {backdata['feedback_id']}")
             return
 
-        await self.db.update_feedback_preference(feedback_id, preference_value)
+        group_id = event.source.group_id if event.source.type == "group" else None
+        await self.db.update_feedback_preference(feedback_id, preference_value, group_id)
         await self.line_bot_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
@@ -281,16 +398,52 @@ def construct_quick_reply(feedback_id):
 
 
 async def main(args):
-    InitLogger(logger, '../data/app.log')
+    InitLogger(
+        logger, '../data/app.log',
+        level=logging.DEBUG if args.debug else logging.INFO,
+        sample_rate=float(os.getenv('LOG_SAMPLE_RATE', 0.1)),
+        max_bytes=int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024)),
+        backup_count=int(os.getenv('LOG_BACKUP_COUNT', 10)),
+    )
 
     if args.debug:
         logger.info("Running in debug mode")
 
+    TRACE_SAMPLE_RATE = os.getenv('TRACE_SAMPLE_RATE', None)
+    if TRACE_SAMPLE_RATE is not None:
+        TRACE_SLOW_THRESHOLD = os.getenv('TRACE_SLOW_THRESHOLD', None)
+        tracer.configure(
+            '../data/traces.jsonl',
+            sample_rate=float(TRACE_SAMPLE_RATE),
+            slow_threshold=float(TRACE_SLOW_THRESHOLD) if TRACE_SLOW_THRESHOLD else None,
+        )
+
     CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET', None)
     CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN', None)
 
     HF_API_TOKEN = os.getenv('HF_API_TOKEN_LIST', "").split(' ')
     OPENAI_API_URL = os.getenv('LLAMA_CPP_SERVER_URL', None)
+    FAST_OPENAI_API_URL = os.getenv('LLAMA_CPP_FAST_SERVER_URL', None)
+    FAST_TIER_QUEUE_DEPTH = os.getenv('FAST_TIER_QUEUE_DEPTH', None)
+    FAST_TIER_LATENCY = os.getenv('FAST_TIER_LATENCY', 1.0)
+    SENTENCE_CACHE_MB = float(os.getenv('SENTENCE_CACHE_MB', 16))
+    NEAR_DUPLICATE_THRESHOLD = os.getenv('NEAR_DUPLICATE_THRESHOLD', None)
+    NEAR_DUPLICATE_MAX_ENTRIES = int(os.getenv('NEAR_DUPLICATE_MAX_ENTRIES', 20000))
+    NEAR_DUPLICATE_MAX_LENGTH = int(os.getenv('NEAR_DUPLICATE_MAX_LENGTH', 32))
+    CJK_CLAUSE_MIN_LENGTH = int(os.getenv('CJK_CLAUSE_MIN_LENGTH', 6))
+    CJK_CLAUSE_MAX_LENGTH = int(os.getenv('CJK_CLAUSE_MAX_LENGTH', 20))
+    EMOJI_LEXICON_PATH = os.getenv('EMOJI_LEXICON_PATH', "../data/emoji_lexicon.bin")
+    ADMISSION_DEGRADE_IN_FLIGHT = int(os.getenv('ADMISSION_DEGRADE_IN_FLIGHT', 300))
+    EMOJILM_BACKEND = os.getenv('EMOJILM_BACKEND', 'openai')
+    LLAMA_CPP_MODEL_PATH = os.getenv('LLAMA_CPP_MODEL_PATH', None)
+    HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 60))
+    BACKEND_CONNECT_TIMEOUT = float(os.getenv('BACKEND_CONNECT_TIMEOUT', 5))
+    BACKEND_READ_TIMEOUT = float(os.getenv('BACKEND_READ_TIMEOUT', 30))
+    CONCURRENCY = 32
+    FEEDBACK_RETENTION_DAYS = os.getenv('FEEDBACK_RETENTION_DAYS', None)
+    FEEDBACK_EXPORT_DIR = os.getenv('FEEDBACK_EXPORT_DIR', "../data/feedback_export")
+    ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', None)
+    LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', 0.25))
     DB_DSN = os.getenv('POSTGRES_DSN', None)
 
     if DB_DSN is None:
@@ -300,23 +453,77 @@ async def main(args):
     else:
         from db_pg import Database
 
-    if CHANNEL_SECRET is None or CHANNEL_ACCESS_TOKEN is None or (len(HF_API_TOKEN) == 0 and OPENAI_API_URL is None):
+    if CHANNEL_SECRET is None or CHANNEL_ACCESS_TOKEN is None or (len(HF_API_TOKEN) == 0 and OPENAI_API_URL is None and LLAMA_CPP_MODEL_PATH is None):
         print(
-            "Please set LINE_CHANNEL_* and (HF_API_TOKEN_LIST or LLAMA_CPP_SERVER_URL).")
+            "Please set LINE_CHANNEL_* and (HF_API_TOKEN_LIST or LLAMA_CPP_SERVER_URL or LLAMA_CPP_MODEL_PATH).")
+        sys.exit(1)
+    if EMOJILM_BACKEND == 'llama_cpp' and LLAMA_CPP_MODEL_PATH is None:
+        print("Please set LLAMA_CPP_MODEL_PATH to a GGUF file for EMOJILM_BACKEND=llama_cpp.")
         sys.exit(1)
 
     configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
+    # The SDK pool defaults to 5 connections per CPU; never go below one per concurrent reply
+    configuration.connection_pool_maxsize = max(
+        configuration.connection_pool_maxsize, CONCURRENCY)
     async_api_client = AsyncApiClient(configuration)
     line_bot_api = AsyncMessagingApi(async_api_client)
     parser = WebhookParser(CHANNEL_SECRET)
 
     db = await Database.create_and_connect(dsn=DB_DSN)
-
-    emojilm = await EmojiLmOpenAi.create(
-        OPENAI_API_URL=OPENAI_API_URL,
-        OPENAI_API_KEY="no_key_required",
-        concurrency=32,
-        sentence_limit=100,
+    database_maintenance_task = asyncio.create_task(database_maintenance_loop(
+        db,
+        retention_days=int(FEEDBACK_RETENTION_DAYS) if FEEDBACK_RETENTION_DAYS else None,
+        export_dir=FEEDBACK_EXPORT_DIR,
+    ))
+
+    lexicon = None
+    if os.path.exists(EMOJI_LEXICON_PATH):
+        lexicon = EmojiLexicon.open(EMOJI_LEXICON_PATH)
+    else:
+        logger.info(f"No emoji lexicon at {EMOJI_LEXICON_PATH}, every sentence goes to the model.")
+
+    if EMOJILM_BACKEND == 'llama_cpp':
+        from emojilm_llama_cpp import EmojiLmLlamaCpp
+        emojilm = await EmojiLmLlamaCpp.create(
+            model_path=LLAMA_CPP_MODEL_PATH,
+            sentence_limit=100,
+            max_batch_size=CONCURRENCY,
+            cache_bytes=int(SENTENCE_CACHE_MB * 1024 * 1024),
+            lexicon=lexicon,
+            min_clause_length=CJK_CLAUSE_MIN_LENGTH,
+            max_clause_length=CJK_CLAUSE_MAX_LENGTH,
+        )
+    else:
+        emojilm = await EmojiLmOpenAi.create(
+            OPENAI_API_URL=OPENAI_API_URL,
+            OPENAI_API_KEY="no_key_required",
+            concurrency=CONCURRENCY,
+            sentence_limit=100,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            connect_timeout=BACKEND_CONNECT_TIMEOUT,
+            read_timeout=BACKEND_READ_TIMEOUT,
+            FAST_OPENAI_API_URL=FAST_OPENAI_API_URL,
+            fast_queue_depth=int(FAST_TIER_QUEUE_DEPTH) if FAST_TIER_QUEUE_DEPTH else None,
+            fast_latency=float(FAST_TIER_LATENCY),
+            cache_bytes=int(SENTENCE_CACHE_MB * 1024 * 1024),
+            lexicon=lexicon,
+            # Near-duplicate reuse is off unless NEAR_DUPLICATE_THRESHOLD is set
+            near_duplicate_threshold=float(NEAR_DUPLICATE_THRESHOLD) if NEAR_DUPLICATE_THRESHOLD else None,
+            near_duplicate_max_entries=NEAR_DUPLICATE_MAX_ENTRIES,
+            near_duplicate_max_length=NEAR_DUPLICATE_MAX_LENGTH,
+            min_clause_length=CJK_CLAUSE_MIN_LENGTH,
+            max_clause_length=CJK_CLAUSE_MAX_LENGTH,
+        )
+    logger.info(f"Using EmojiLm backend: {type(emojilm).__name__}")
+
+    admission = AdmissionController(
+        user_burst=float(os.getenv('ADMISSION_USER_BURST', 60)),
+        user_rate=float(os.getenv('ADMISSION_USER_RATE', 1)),
+        group_burst=float(os.getenv('ADMISSION_GROUP_BURST', 120)),
+        group_rate=float(os.getenv('ADMISSION_GROUP_RATE', 2)),
+        max_in_flight=int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 400)),
+        # Degrading to lexicon-only replies needs a lexicon to answer from
+        degrade_in_flight=ADMISSION_DEGRADE_IN_FLIGHT if lexicon is not None else None,
     )
 
     handler = Handler(
@@ -324,10 +531,20 @@ async def main(args):
         parser=parser,
         emojilm=emojilm,
         db=db,
+        admission=admission,
     )
 
     app = web.Application()
     app.add_routes([web.post('/callback', handler.handle_callback)])
+    loop_monitor = LoopLagMonitor(threshold=LOOP_LAG_THRESHOLD)
+    loop_monitor.start()
+
+    if ADMIN_TOKEN:
+        admin_handler = AdminHandler(
+            db=db, handler=handler, token=ADMIN_TOKEN, loop_monitor=loop_monitor)
+        app.add_routes(admin_handler.routes())
+    else:
+        logger.info("ADMIN_TOKEN is not set, admin routes are disabled.")
 
     runner = web.AppRunner(app)
     await runner.setup()
@@ -340,26 +557,44 @@ async def main(args):
         while True:
             await asyncio.sleep(600)
     finally:
+        await loop_monitor.stop()
+        # A compaction in progress must stop before the pool it exports from is closed
+        database_maintenance_task.cancel()
+        try:
+            await database_maintenance_task
+        except asyncio.CancelledError:
+            pass
         await db.close()
         await site.stop()
         await runner.cleanup()
         await async_api_client.close()
         await emojilm.close()
+        if lexicon is not None:
+            lexicon.close()
 
 
-def InitLogger(rootLogger, log_path: str) -> logging.Logger:
+def InitLogger(rootLogger, log_path: str, level=logging.INFO, sample_rate: float = 1.0,
+               max_bytes: int = 50 * 1024 * 1024, backup_count: int = 10) -> logging.Logger:
     logFormatter = logging.Formatter(
         "%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s] [%(module)-16s:%(lineno)-4s] %(message)s")
 
-    rootLogger.setLevel(logging.INFO)
+    rootLogger.setLevel(level)
 
-    fileHandler = logging.FileHandler(log_path, encoding='utf8')
+    fileHandler = create_rotating_file_handler(log_path, max_bytes, backup_count)
     fileHandler.setFormatter(logFormatter)
-    rootLogger.addHandler(fileHandler)
 
     consoleHandler = logging.StreamHandler(sys.stdout)
     consoleHandler.setFormatter(logFormatter)
-    rootLogger.addHandler(consoleHandler)
+
+    # The event loop only enqueues records; formatting and I/O happen on the listener thread
+    log_queue = queue.SimpleQueue()
+    queueHandler = LazyQueueHandler(log_queue)
+    queueHandler.addFilter(SamplingFilter(sample_rate))
+    rootLogger.addHandler(queueHandler)
+
+    listener = QueueListener(log_queue, fileHandler, consoleHandler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
     return rootLogger
 
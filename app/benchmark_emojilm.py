@@ -0,0 +1,80 @@
+'''
+Benchmarks the per-message latency of the EmojiLm backends.
+
+Example:
+    python benchmark_emojilm.py --backend openai --url http://localhost:7777
+    python benchmark_emojilm.py --backend llama_cpp --model ../llama-cpp-server/emojilm-0.6b-q8_0.gguf
+'''
+
+import asyncio
+import logging
+import statistics
+import time
+from argparse import ArgumentParser
+
+SAMPLE_TEXTS = [
+    "笑死",
+    "好喔 那你很厲害誒",
+    "I love you",
+    "今天天氣很好，我們去公園散步吧！晚上再一起吃火鍋。",
+    "The weather is great today. Let's go for a walk in the park! Then we can grab dinner together.",
+    "立法院今天三讀通過紀念日及節日實施條例，新增教師節、光復節、行憲紀念日等休假，勞動節改為全國放假。",
+]
+
+
+async def create_backend(args):
+    if args.backend == 'llama_cpp':
+        from emojilm_llama_cpp import EmojiLmLlamaCpp
+        return await EmojiLmLlamaCpp.create(
+            model_path=args.model,
+            sentence_limit=500,
+            max_batch_size=args.concurrency,
+        )
+    from emojilm_openai import EmojiLmOpenAi
+    return await EmojiLmOpenAi.create(
+        OPENAI_API_URL=args.url,
+        OPENAI_API_KEY="no_key_required",
+        concurrency=args.concurrency,
+        sentence_limit=500,
+    )
+
+
+async def main(args):
+    logging.basicConfig(level=logging.WARNING)
+    emojilm = await create_backend(args)
+
+    latencies = []
+    try:
+        # Warm up once so model loading and connection setup are not measured
+        await emojilm.generate(SAMPLE_TEXTS[0])
+
+        for _ in range(args.rounds):
+            for text in SAMPLE_TEXTS:
+                # Bypass the sentence cache so every round reaches the backend
+                emojilm.cache_clear()
+                start = time.perf_counter()
+                await emojilm.generate(text)
+                latencies.append(time.perf_counter() - start)
+    finally:
+        await emojilm.close()
+
+    latencies.sort()
+    print(f"Backend: {type(emojilm).__name__}")
+    print(f"Messages: {len(latencies)}")
+    print(f"Mean: {statistics.mean(latencies) * 1000:.1f} ms")
+    print(f"p50: {latencies[len(latencies) // 2] * 1000:.1f} ms")
+    print(f"p95: {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms")
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--backend', choices=['openai', 'llama_cpp'], default='openai')
+    parser.add_argument('--url', default="http://localhost:7777")
+    parser.add_argument('--model', default="../llama-cpp-server/emojilm-0.6b-q8_0.gguf")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=5)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,84 @@
+'''
+Measures how many model calls clause coalescing saves on CJK messages: each fragment or clause
+`preprocess_input_text` yields costs one backend query.
+
+The sample corpus is built in; pass --file to measure your own messages, one per line (a literal
+"\\n" inside a line stands for a newline).
+
+Example:
+    python benchmark_segmentation.py --min-length 6 --max-length 20
+'''
+
+from argparse import ArgumentParser
+
+from segmentation import URL_PATTERN, coalesce_fragments, split_cjk
+
+SAMPLE_TEXTS = [
+    "笑死",
+    "好喔 那你很厲害誒",
+    "真的假的 我也要 哈哈哈",
+    "今天天氣很好，我們去公園散步吧！晚上再一起吃火鍋。",
+    "最近UNIQLO大便事件\n有網友抓到去年梯本自駕車禍那件事也是他們家在搞\n出事了還在那邊嘻嘻哈哈合照\n\n（老爸是長髮男）",
+    "欸 你到了沒 我在門口 好冷喔 快點啦",
+    "明天 早上 九點 開會 記得 帶 電腦",
+    "不要 不要 不要 拜託 我錯了",
+    "哈哈 好 我晚點打給你 先去洗澡 掰掰",
+    "謝謝大家 今天辛苦了 晚安 明天見",
+    "這家店 超好吃 但是 要排隊 排了 一個小時 https://example.com/menu",
+    "ちょっと待って、今行く、すぐ着くよ",
+    "오늘 진짜 피곤해 집에 가고 싶다",
+    "立法院今（9日）三讀通過國民黨立法院黨團與民眾黨立法院黨團版「紀念日及節日實施條例」草案，該案被在野稱為「還假於民」法案。"
+    "此次新增教師節、光復節、行憲紀念日（同日也是聖誕節）、小年夜等4天休假一天，勞動假從原本僅勞工族群放假一日，改為全國性休假，意即所謂的「4+1」休假。",
+    "立法院9日下午1時半許進行逐條表決，全案結果皆為出席110位委員，贊成59位、反對51位，贊成者多數通過。"
+    "經藍白黨團提議進行三讀，在議事人員宣讀全案後，進行全案表決。",
+    "條例第9條提及，由於上述第4、6條等放假日調整，「交通運輸、警察、消防、海巡、醫療、關務、矯正等全年無休實施輪班、輪休制度之政府機關或機構，由目的事業主管機關調移之」。",
+]
+
+
+def count_calls(text: str, min_length: int, max_length: int) -> tuple[int, int]:
+    """Returns the number of fragments and of coalesced clauses, i.e. model calls without and with coalescing."""
+    sentence_list, delimiter_list = split_cjk(URL_PATTERN.sub('', text))
+    clauses, clause_delimiters = coalesce_fragments(sentence_list, delimiter_list, min_length, max_length)
+    # Coalescing must not lose or reorder any text
+    assert "".join(s + d for s, d in zip(clauses, clause_delimiters)) == \
+        "".join(s + d for s, d in zip(sentence_list, delimiter_list))
+    return len(sentence_list), len(clauses)
+
+
+def main(args):
+    if args.file is not None:
+        with open(args.file, encoding="utf-8") as f:
+            texts = [line.rstrip("\n").replace("\\n", "\n") for line in f if line.strip()]
+    else:
+        texts = SAMPLE_TEXTS
+
+    print(f"min length {args.min_length}, max length {args.max_length}")
+    print(f"{'fragments':>9} {'clauses':>8} {'saved':>6}  message")
+    total_fragments = 0
+    total_clauses = 0
+    for text in texts:
+        fragments, clauses = count_calls(text, args.min_length, args.max_length)
+        total_fragments += fragments
+        total_clauses += clauses
+        preview = text.replace("\n", " ")
+        if len(preview) > 30:
+            preview = preview[:30] + "…"
+        print(f"{fragments:>9} {clauses:>8} {fragments - clauses:>6}  {preview}")
+
+    saved = total_fragments - total_clauses
+    print(f"\n{len(texts)} messages: {total_fragments} fragments -> {total_clauses} clauses, "
+          f"{saved} backend calls saved ({saved / max(total_fragments, 1):.0%} fewer), "
+          f"{total_fragments / len(texts):.1f} -> {total_clauses / len(texts):.1f} calls per message")
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--file', default=None,
+                        help="Messages to measure, one per line; the built-in corpus if unset")
+    parser.add_argument('--min-length', type=int, default=6)
+    parser.add_argument('--max-length', type=int, default=20)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,128 @@
+'''
+Measures the client-side per-request overhead of talking to a completions endpoint.
+
+A stub server answers every request instantly with a fixed completion, so the numbers
+only contain session, serialization and socket costs (client and stub share one process).
+
+Example:
+    python benchmark_transport.py --requests 5000
+'''
+
+import asyncio
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from urllib.parse import urljoin
+
+import aiohttp
+import orjson
+from aiohttp import web
+from http_transport import create_client_session
+
+COMPLETION = {"choices": [{"text": "😂😂", "index": 0}], "model": "emojilm"}
+PAYLOAD_TEMPLATE = {
+    "model": "emojilm",
+    "max_tokens": 5,
+    "temperature": 0.3,
+    "frequency_penalty": 1.1,
+    "top_p": 0.7,
+    "stop": ["\n", "\t", " ", '.'],
+}
+
+
+async def handle_completion(request):
+    await request.read()
+    return web.json_response(COMPLETION)
+
+
+async def start_stub_server(port, socket_path):
+    app = web.Application()
+    app.add_routes([web.post('/v1/completions', handle_completion)])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', port).start()
+    await web.UnixSite(runner, socket_path).start()
+    return runner
+
+
+async def run_default(url, n, concurrency):
+    """Mirrors the previous EmojiLmOpenAi.query hot path."""
+    session = aiohttp.ClientSession()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        payload = {**PAYLOAD_TEMPLATE, "prompt": f"sentence {i}"}
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer no_key_required"
+        }
+        async with semaphore:
+            async with session.post(urljoin(url, "v1/completions"), headers=headers, json=payload) as response:
+                resp = await response.json()
+                return resp['choices'][0]['text']
+
+    try:
+        return await timed(one, n)
+    finally:
+        await session.close()
+
+
+async def run_tuned(url, n, concurrency):
+    """Mirrors the current EmojiLmOpenAi.query hot path."""
+    session, base_url = create_client_session(url, pool_size=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    completions_url = urljoin(base_url, "v1/completions")
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": "Bearer no_key_required"
+    }
+
+    async def one(i):
+        payload = orjson.dumps({**PAYLOAD_TEMPLATE, "prompt": f"sentence {i}"})
+        async with semaphore:
+            async with session.post(completions_url, headers=headers, data=payload) as response:
+                resp = orjson.loads(await response.read())
+                return resp['choices'][0]['text']
+
+    try:
+        return await timed(one, n)
+    finally:
+        await session.close()
+
+
+async def timed(one, n):
+    # Warm up the connection pool before measuring
+    await asyncio.gather(*(one(i) for i in range(32)))
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    return (time.perf_counter() - start) / n
+
+
+async def main(args):
+    socket_path = os.path.join(tempfile.mkdtemp(), "llama.sock")
+    runner = await start_stub_server(args.port, socket_path)
+    tcp_url = f"http://localhost:{args.port}"
+    try:
+        results = {
+            "default session, TCP": await run_default(tcp_url, args.requests, args.concurrency),
+            "tuned session, TCP": await run_tuned(tcp_url, args.requests, args.concurrency),
+            "tuned session, Unix socket": await run_tuned(f"unix://{socket_path}", args.requests, args.concurrency),
+        }
+    finally:
+        await runner.cleanup()
+
+    for name, per_request in results.items():
+        print(f"{name:<28} {per_request * 1e6:8.1f} us/request")
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--port', type=int, default=17777)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
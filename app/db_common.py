@@ -0,0 +1,195 @@
+'''
+Helpers shared by the PostgreSQL and SQLite `Database` backends.
+'''
+
+import asyncio
+import logging
+from datetime import date, datetime
+
+logger = logging.getLogger(__name__)
+
+FEEDBACK_PARTITION_PREFIX = "feedback_p"
+
+# Counters kept per (day, chat_id) in the usage_daily rollup table. chat_id is a group id,
+# or USAGE_ALL_CHATS for the totals across every chat.
+USAGE_COUNTERS = ("messages", "help_requests", "active_users",
+                  "feedback", "likes", "dislikes")
+USAGE_ALL_CHATS = "*"
+
+
+def month_start(dt: datetime) -> datetime:
+    return datetime(dt.year, dt.month, 1)
+
+
+def next_month_start(dt: datetime) -> datetime:
+    if dt.month == 12:
+        return datetime(dt.year + 1, 1, 1)
+    return datetime(dt.year, dt.month + 1, 1)
+
+
+def feedback_partition_name(dt: datetime) -> str:
+    """Name of the monthly feedback partition holding rows created at `dt`, e.g. feedback_p2025_07."""
+    return f"{FEEDBACK_PARTITION_PREFIX}{dt.year:04d}_{dt.month:02d}"
+
+
+def feedback_partition_upper_bound(name: str) -> datetime:
+    """Exclusive upper bound of the rows' create_time in a monthly feedback partition."""
+    year, month = name[len(FEEDBACK_PARTITION_PREFIX):].split('_')
+    return next_month_start(datetime(int(year), int(month), 1))
+
+
+def vote_counters(previous: int, preference: int) -> dict[str, int]:
+    """usage_daily changes for a stored preference going from `previous` (None if unrated) to `preference`.
+
+    Repeating a vote changes nothing, and changing it moves it from likes to dislikes or back.
+    """
+    if previous == preference:
+        return {}
+    counters = {"likes" if preference > 0 else "dislikes": 1}
+    if previous is not None:
+        counters["likes" if previous > 0 else "dislikes"] = -1
+    return counters
+
+
+def usage_day(*candidates: datetime) -> date:
+    """Day a usage event is rolled up under: the first timestamp given, or today."""
+    for dt in candidates:
+        if dt is not None:
+            return dt.date()
+    return date.today()
+
+
+class FeedbackIdAllocator:
+    """Hands out feedback ids from blocks reserved in the database.
+
+    `reserve_block` must atomically reserve `block_size` ids and return the first one,
+    so ids stay unique across restarts without a round trip per message.
+    """
+
+    def __init__(self, reserve_block, block_size: int):
+        self.reserve_block = reserve_block
+        self.block_size = block_size
+        self.next_id = 0
+        self.block_end = 0
+        self.lock = asyncio.Lock()
+
+    async def allocate(self) -> int:
+        async with self.lock:
+            if self.next_id >= self.block_end:
+                self.next_id = await self.reserve_block(self.block_size)
+                self.block_end = self.next_id + self.block_size
+                logger.debug(
+                    f"Reserved feedback ids [{self.next_id}, {self.block_end})")
+            feedback_id = self.next_id
+            self.next_id += 1
+            return feedback_id
+
+
+class FeedbackBatcher:
+    """Buffers feedback rows and writes them in batches off the reply path.
+
+    Rows are `(id, input, output, user_id, create_time, preference)` tuples.
+    Preferences that arrive before their row has been written are applied to the
+    buffered row, or re-applied right after the batch holding it lands.
+    A batch that fails to write is retried with the next flushes; after `max_attempts`
+    its rows are written one by one, so a bad row only loses itself.
+    """
+
+    def __init__(self, write_rows, update_preferences, flush_interval: float = 0.5, max_batch_size: int = 100,
+                 max_attempts: int = 3):
+        self.write_rows = write_rows
+        self.update_preferences = update_preferences
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.max_attempts = max_attempts
+
+        self.rows: dict[int, list] = {}
+        self.in_flight: dict[int, list] = {}
+        self.late_preferences: dict[int, int] = {}
+        self.failed_attempts = 0
+        self.flush_lock = asyncio.Lock()
+        self.batch_full = asyncio.Event()
+        self.closed = False
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    def add(self, feedback_id: int, input_text: str, output_text: str, user_id: str, create_time: datetime):
+        self.rows[feedback_id] = [feedback_id, input_text,
+                                  output_text, user_id, create_time, None]
+        if len(self.rows) >= self.max_batch_size:
+            self.batch_full.set()
+
+    def set_preference(self, feedback_id: int, preference: int) -> tuple[datetime, int] | None:
+        """Returns the buffered row's create_time and previous preference, or None if the row is already in the database."""
+        if feedback_id in self.rows:
+            row = self.rows[feedback_id]
+            previous, row[5] = row[5], preference
+            return row[4], previous
+        if feedback_id in self.in_flight:
+            row = self.in_flight[feedback_id]
+            previous = self.late_preferences.get(feedback_id, row[5])
+            self.late_preferences[feedback_id] = preference
+            return row[4], previous
+        return None
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.rows:
+                return
+            self.in_flight, self.rows = self.rows, {}
+            try:
+                if not await self._write_in_flight():
+                    return
+                # Preferences can keep arriving while earlier ones are written
+                while self.late_preferences:
+                    late_preferences, self.late_preferences = self.late_preferences, {}
+                    await self.update_preferences(list(late_preferences.items()))
+            except Exception:
+                logger.exception("Failed to write late feedback preferences")
+            finally:
+                self.in_flight = {}
+                self.late_preferences = {}
+
+    async def _write_in_flight(self) -> bool:
+        """Writes the in-flight rows; returns False if they were put back for the next flush instead."""
+        rows = [tuple(row) for row in self.in_flight.values()]
+        try:
+            await self.write_rows(rows)
+            self.failed_attempts = 0
+            return True
+        except Exception:
+            self.failed_attempts += 1
+            if self.failed_attempts < self.max_attempts:
+                logger.exception(
+                    f"Failed to write {len(rows)} feedback rows (attempt {self.failed_attempts}), retrying")
+                # Nothing was written, so late preferences go straight into the rows
+                for feedback_id, preference in self.late_preferences.items():
+                    self.in_flight[feedback_id][5] = preference
+                self.rows = {**self.in_flight, **self.rows}
+                return False
+            logger.exception(
+                f"Failed to write {len(rows)} feedback rows {self.failed_attempts} times, writing them one by one")
+        self.failed_attempts = 0
+        for row in rows:
+            try:
+                await self.write_rows([row])
+            except Exception:
+                logger.exception(f"Dropped feedback row {row[0]}")
+        return True
+
+    async def _flush_loop(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.batch_full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.batch_full.clear()
+            await self.flush()
+
+    async def close(self):
+        # Wake the loop and let a flush in progress finish; cancelling it mid-write would drop the batch
+        self.closed = True
+        self.batch_full.set()
+        await self.flush_task
+        # Retries are bounded, so this ends once every row is written or dropped
+        while self.rows:
+            await self.flush()
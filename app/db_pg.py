@@ -1,14 +1,32 @@
 import logging
-from datetime import datetime
+import re
+from collections import Counter
+from datetime import date, datetime
 
 import asyncpg
+from db_common import (FEEDBACK_PARTITION_PREFIX, USAGE_ALL_CHATS,
+                       USAGE_COUNTERS, FeedbackBatcher, FeedbackIdAllocator,
+                       feedback_partition_name, feedback_partition_upper_bound,
+                       month_start, next_month_start, usage_day,
+                       vote_counters)
+from tracing import traced
 
 logger = logging.getLogger(__name__)
 
+# Upper bound in a partition bound expression, e.g. FOR VALUES FROM (MINVALUE) TO ('2025-08-01 00:00:00')
+PARTITION_UPPER_BOUND_PATTERN = re.compile(r"TO \('([^']+)'\)")
+
 
 class Database:
+    FEEDBACK_ID_BLOCK_SIZE = 1000
+
     def __init__(self, pool: asyncpg.Pool):
         self.pool = pool
+        self.feedback_partitioned = False
+        self.feedback_id_allocator = FeedbackIdAllocator(
+            self._reserve_feedback_id_block, self.FEEDBACK_ID_BLOCK_SIZE)
+        self.feedback_batcher = FeedbackBatcher(
+            self._write_feedback_rows, self._write_feedback_preferences)
 
     @classmethod
     async def create_and_connect(cls, dsn: str, min_size: int = 1, max_size: int = 10, timeout: int = 60):
@@ -25,17 +43,55 @@ class Database:
             logger.error(f"Error creating PostgreSQL connection pool: {e}")
             raise  # Re-raise the exception to indicate failure
 
-        return cls(pool)
+        db = cls(pool)
+        await db.create_user_tables()
+        await db.create_feedback_table()
+        await db.ensure_feedback_partitions(datetime.now())
+        await db.create_feedback_id_sequence()
+        await db.create_usage_tables()
+        return db
 
     async def close(self):
+        await self.feedback_batcher.close()
         if self.pool:
             await self.pool.close()
             logger.info("PostgreSQL connection pool closed.")
 
+    async def create_user_tables(self):
+        """Create the users and groups tables if they do not exist."""
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id TEXT PRIMARY KEY,
+                    help_count INTEGER NOT NULL DEFAULT 0,
+                    block BOOLEAN,
+                    last_block TIMESTAMP,
+                    msg_count INTEGER NOT NULL DEFAULT 0,
+                    last_use TIMESTAMP,
+                    first_use TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS groups (
+                    id TEXT PRIMARY KEY,
+                    leave BOOLEAN,
+                    msg_count INTEGER NOT NULL DEFAULT 0,
+                    last_use TIMESTAMP,
+                    first_use TIMESTAMP
+                );
+            """)
+
     # --- User Methods ---
 
+    @traced("db.upsert_user")
     async def upsert_user(self, user_id: str, help_count_inc: int = 0, block: bool = None, last_block: datetime = None, msg_count_inc: int = 0, last_use: datetime = None, first_use: datetime = None):
         """Inserts a new user or updates an existing one."""
+        args = (user_id, help_count_inc, block, last_block, msg_count_inc, last_use, first_use)
+        try:
+            await self._upsert_user(*args)
+        except asyncpg.UniqueViolationError:
+            # A concurrent upsert inserted the user first; the retry takes the update path
+            await self._upsert_user(*args)
+
+    async def _upsert_user(self, user_id: str, help_count_inc: int, block: bool, last_block: datetime, msg_count_inc: int, last_use: datetime, first_use: datetime):
         async with self.pool.acquire() as conn:
             # Use a transaction for the upsert logic to ensure atomicity
             async with conn.transaction():
@@ -53,19 +109,31 @@ class Database:
                         WHERE id = $1
                     """
                     await conn.execute(update_query, user_id, help_count_inc, msg_count_inc, last_use, block, last_block)
-                    logger.debug(f"Updated user: {user_id}")
+                    logger.debug("Updated user: %s", user_id)
                 else:
                     insert_query = """
                         INSERT INTO users (id, help_count, block, last_block, msg_count, last_use, first_use)
-                        VALUES ($1, $2, $3, $4, $5, COALESCE($6, $7), COALESCE($7, $6))
+                        VALUES ($1, $2, $3, $4, $5, COALESCE($6::timestamp, $7::timestamp), COALESCE($7::timestamp, $6::timestamp))
                     """
                     await conn.execute(insert_query, user_id, help_count_inc, block, last_block, msg_count_inc, last_use, first_use)
-                    logger.debug(f"Inserted new user: {user_id}")
+                    logger.debug("Inserted new user: %s", user_id)
+
+                if msg_count_inc or help_count_inc:
+                    await self._record_user_activity(conn, user_id, usage_day(last_use, first_use), msg_count_inc, help_count_inc)
 
     # --- Group Methods ---
 
+    @traced("db.upsert_group")
     async def upsert_group(self, group_id: str, leave: bool = None, msg_count_inc: int = 0, last_use: datetime = None, first_use: datetime = None):
         """Inserts a new group or updates an existing one."""
+        args = (group_id, leave, msg_count_inc, last_use, first_use)
+        try:
+            await self._upsert_group(*args)
+        except asyncpg.UniqueViolationError:
+            # A concurrent upsert inserted the group first; the retry takes the update path
+            await self._upsert_group(*args)
+
+    async def _upsert_group(self, group_id: str, leave: bool, msg_count_inc: int, last_use: datetime, first_use: datetime):
         async with self.pool.acquire() as conn:
             async with conn.transaction():
                 existing_group = await conn.fetchrow("SELECT * FROM groups WHERE id = $1", group_id)
@@ -80,32 +148,254 @@ class Database:
                         WHERE id = $1
                     """
                     await conn.execute(update_query, group_id, leave, msg_count_inc, last_use)
-                    logger.debug(f"Updated group: {group_id}")
+                    logger.debug("Updated group: %s", group_id)
                 else:
                     insert_query = """
                         INSERT INTO groups (id, leave, msg_count, last_use, first_use)
-                        VALUES ($1, $2, $3, COALESCE($4, $5), COALESCE($5, $4))
+                        VALUES ($1, $2, $3, COALESCE($4::timestamp, $5::timestamp), COALESCE($5::timestamp, $4::timestamp))
                     """
                     await conn.execute(insert_query, group_id, leave, msg_count_inc, last_use, first_use)
-                    logger.debug(f"Inserted new group: {group_id}")
+                    logger.debug("Inserted new group: %s", group_id)
+
+                if msg_count_inc:
+                    await self._increment_usage(conn, usage_day(last_use, first_use), group_id, messages=msg_count_inc)
 
     # --- Feedback Methods ---
 
-    async def insert_feedback(self, input_text: str, output_text: str, user_id: str, create_time: datetime) -> int:
-        """Inserts a new feedback entry and returns its ID."""
+    async def create_feedback_table(self):
+        """Create the feedback table, range-partitioned by month on create_time, if it does not exist."""
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS feedback (
+                    id BIGINT NOT NULL,
+                    input TEXT NOT NULL,
+                    output TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    create_time TIMESTAMP NOT NULL,
+                    preference INTEGER,
+                    PRIMARY KEY (id, create_time)
+                ) PARTITION BY RANGE (create_time)
+            """)
+            self.feedback_partitioned = await conn.fetchval("""
+                SELECT EXISTS (
+                    SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'feedback'::regclass
+                )
+            """)
+            if self.feedback_partitioned:
+                await conn.execute("""
+                    CREATE INDEX IF NOT EXISTS feedback_create_time_idx ON feedback (create_time);
+                    CREATE INDEX IF NOT EXISTS feedback_user_id_idx ON feedback (user_id);
+                """)
+        if not self.feedback_partitioned:
+            logger.warning(
+                "feedback table is not partitioned; retention and compaction are disabled. See deploy.md for the migration.")
+
+    async def ensure_feedback_partitions(self, now: datetime):
+        """Create the partitions for the current and the next month.
+
+        A month a migrated partition like feedback_legacy already covers is skipped, and one it covers
+        in part starts at its upper bound, since overlapping ranges cannot be attached.
+        """
+        if not self.feedback_partitioned:
+            return
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+                FROM pg_inherits
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE pg_inherits.inhparent = 'feedback'::regclass
+            """)
+            existing = {row['name'] for row in rows}
+            upper_bounds = [datetime.fromisoformat(match.group(1)) for row in rows
+                            if not row['name'].startswith(FEEDBACK_PARTITION_PREFIX)
+                            and (match := PARTITION_UPPER_BOUND_PATTERN.search(row['bound']))]
+            covered_until = max(upper_bounds, default=datetime.min)
+
+            for start in (month_start(now), next_month_start(now)):
+                name = feedback_partition_name(start)
+                end = next_month_start(start)
+                lower = max(start, covered_until)
+                if name in existing or lower >= end:
+                    continue
+                await conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {name} PARTITION OF feedback
+                    FOR VALUES FROM ('{lower.isoformat()}') TO ('{end.isoformat()}')
+                """)
+        logger.debug("Feedback partitions verified.")
+
+    async def list_feedback_partitions(self) -> list[tuple[str, datetime]]:
+        """Returns (partition name, exclusive create_time upper bound) pairs, oldest first.
+
+        Other partitions, like feedback_legacy from the migration in deploy.md, are listed first,
+        bounded by their newest row, while they hold any rows.
+        """
+        if not self.feedback_partitioned:
+            return []
+        partitions = []
+        names = []
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT child.relname AS name
+                FROM pg_inherits
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE pg_inherits.inhparent = 'feedback'::regclass
+            """)
+            for name in sorted(row['name'] for row in rows):
+                if name.startswith(FEEDBACK_PARTITION_PREFIX):
+                    names.append(name)
+                    continue
+                max_time = await conn.fetchval(f"SELECT MAX(create_time) FROM {name}")
+                if max_time is not None:
+                    partitions.append((name, max_time))
+        partitions.extend((name, feedback_partition_upper_bound(name)) for name in names)
+        return partitions
+
+    async def read_feedback_partition(self, name: str, after_id: int, limit: int) -> list[tuple]:
+        """Reads up to `limit` rows of a partition with id greater than `after_id`, ordered by id."""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(f"""
+                SELECT id, input, output, user_id, create_time, preference
+                FROM {name} WHERE id > $1 ORDER BY id LIMIT $2
+            """, after_id, limit)
+        return [tuple(row) for row in rows]
+
+    async def drop_feedback_partition(self, name: str):
+        """Detaches a partition without blocking inserts into the others, then drops it."""
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                INSERT INTO feedback (input, output, user_id, create_time)
-                VALUES ($1, $2, $3, $4)
-                RETURNING id
-            """, input_text, output_text, user_id, create_time)
-            return row['id']
+            await conn.execute(f"ALTER TABLE feedback DETACH PARTITION {name} CONCURRENTLY")
+            await conn.execute(f"DROP TABLE {name}")
+        logger.info(f"Dropped feedback partition {name}")
 
-    async def update_feedback_preference(self, feedback_id: int, preference: int):
-        """Updates the preference for a feedback entry."""
+    async def create_feedback_id_sequence(self):
+        """Create the sequence feedback id blocks are reserved from, ahead of any existing id."""
+        async with self.pool.acquire() as conn:
+            await conn.execute(f"""
+                CREATE SEQUENCE IF NOT EXISTS feedback_id_block_seq INCREMENT BY {self.FEEDBACK_ID_BLOCK_SIZE};
+                SELECT setval('feedback_id_block_seq', GREATEST(
+                    (SELECT last_value FROM feedback_id_block_seq),
+                    (SELECT COALESCE(MAX(id), 0) FROM feedback) + 1
+                ));
+            """)
+
+    async def _reserve_feedback_id_block(self, block_size: int) -> int:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT nextval('feedback_id_block_seq')")
+
+    @traced("db.allocate_feedback_id")
+    async def allocate_feedback_id(self) -> int:
+        """Returns a feedback id that can be used before its row is inserted."""
+        return await self.feedback_id_allocator.allocate()
+
+    @traced("db.insert_feedback")
+    async def insert_feedback(self, feedback_id: int, input_text: str, output_text: str, user_id: str, create_time: datetime):
+        """Queues a new feedback entry; it is written with the next batch."""
+        self.feedback_batcher.add(
+            feedback_id, input_text, output_text, user_id, create_time)
+
+    @traced("db.write_feedback_rows")
+    async def _write_feedback_rows(self, rows: list[tuple]):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany("""
+                    INSERT INTO feedback (id, input, output, user_id, create_time, preference)
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                """, rows)
+                for day, count in Counter(row[4].date() for row in rows).items():
+                    await self._increment_usage(conn, day, USAGE_ALL_CHATS, feedback=count)
+
+    @traced("db.write_feedback_preferences")
+    async def _write_feedback_preferences(self, preferences: list[tuple[int, int]]):
+        async with self.pool.acquire() as conn:
+            await conn.executemany("""
+                UPDATE feedback SET preference = $2 WHERE id = $1
+            """, preferences)
+
+    @traced("db.update_feedback_preference")
+    async def update_feedback_preference(self, feedback_id: int, preference: int, group_id: str = None):
+        """Updates the preference for a feedback entry, which may still be queued.
+
+        The vote is rolled up under the feedback's day, for all chats and for `group_id`, if the preference changed.
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                queued = self.feedback_batcher.set_preference(feedback_id, preference)
+                if queued is not None:
+                    create_time, previous = queued
+                else:
+                    row = await conn.fetchrow("""
+                        SELECT create_time, preference FROM feedback WHERE id = $1 FOR UPDATE
+                    """, feedback_id)
+                    if row is None:
+                        logger.warning(f"No feedback {feedback_id} to set preference {preference} on")
+                        return
+                    create_time, previous = row['create_time'], row['preference']
+                    if previous != preference:
+                        await conn.execute("""
+                            UPDATE feedback SET preference = $1 WHERE id = $2 AND create_time = $3
+                        """, preference, feedback_id, create_time)
+                counters = vote_counters(previous, preference)
+                if counters:
+                    for chat_id in (USAGE_ALL_CHATS, group_id) if group_id else (USAGE_ALL_CHATS,):
+                        await self._increment_usage(conn, create_time.date(), chat_id, **counters)
+        logger.debug("Updated feedback %d with preference %d",
+                     feedback_id, preference)
+
+    # --- Usage Rollup Methods ---
+
+    async def create_usage_tables(self):
+        """Create the usage rollup tables if they do not exist."""
         async with self.pool.acquire() as conn:
             await conn.execute("""
-                UPDATE feedback SET preference = $1 WHERE id = $2
-            """, preference, feedback_id)
-            logger.debug(
-                f"Updated feedback {feedback_id} with preference {preference}")
+                CREATE TABLE IF NOT EXISTS usage_daily (
+                    day DATE NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    messages BIGINT NOT NULL DEFAULT 0,
+                    help_requests BIGINT NOT NULL DEFAULT 0,
+                    active_users BIGINT NOT NULL DEFAULT 0,
+                    feedback BIGINT NOT NULL DEFAULT 0,
+                    likes BIGINT NOT NULL DEFAULT 0,
+                    dislikes BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, chat_id)
+                );
+                CREATE TABLE IF NOT EXISTS daily_active_users (
+                    day DATE NOT NULL,
+                    user_id TEXT NOT NULL,
+                    PRIMARY KEY (day, user_id)
+                );
+            """)
+
+    async def _increment_usage(self, conn: asyncpg.Connection, day: date, chat_id: str, **counters: int):
+        columns = [name for name in USAGE_COUNTERS if name in counters]
+        await conn.execute(f"""
+            INSERT INTO usage_daily (day, chat_id, {', '.join(columns)})
+            VALUES ($1, $2, {', '.join(f'${i}' for i in range(3, len(columns) + 3))})
+            ON CONFLICT (day, chat_id) DO UPDATE SET
+                {', '.join(f'{name} = usage_daily.{name} + excluded.{name}' for name in columns)}
+        """, day, chat_id, *(counters[name] for name in columns))
+
+    async def _record_user_activity(self, conn: asyncpg.Connection, user_id: str, day: date, msg_count_inc: int, help_count_inc: int):
+        status = await conn.execute("""
+            INSERT INTO daily_active_users (day, user_id) VALUES ($1, $2)
+            ON CONFLICT (day, user_id) DO NOTHING
+        """, day, user_id)
+        await self._increment_usage(
+            conn, day, USAGE_ALL_CHATS,
+            messages=msg_count_inc,
+            help_requests=help_count_inc,
+            active_users=int(status.split()[-1]),
+        )
+
+    async def prune_daily_active_users(self, before: date):
+        """Drops the per-user rows only needed to count a day's distinct active users."""
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM daily_active_users WHERE day < $1", before)
+
+    async def get_usage_stats(self, day: date, chat_id: str = USAGE_ALL_CHATS) -> dict[str, int]:
+        """Returns the rolled up counters of one chat (or all chats) on one day."""
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(f"""
+                SELECT {', '.join(USAGE_COUNTERS)} FROM usage_daily WHERE day = $1 AND chat_id = $2
+            """, day, chat_id)
+        if row is None:
+            return dict.fromkeys(USAGE_COUNTERS, 0)
+        return dict(row)
@@ -1,17 +1,51 @@
 import asyncio
 import logging
-from datetime import datetime
+from collections import Counter
+from datetime import date, datetime
 
 import aiosqlite
+from db_common import (FEEDBACK_PARTITION_PREFIX, USAGE_ALL_CHATS,
+                       USAGE_COUNTERS, FeedbackBatcher, FeedbackIdAllocator,
+                       feedback_partition_name, feedback_partition_upper_bound,
+                       month_start, next_month_start, usage_day,
+                       vote_counters)
+from tracing import traced
 
 logger = logging.getLogger(__name__)
 
+# Rows written before partitioning stay in `feedback`; new rows go to monthly feedback_pYYYY_MM tables.
+LEGACY_FEEDBACK_TABLE = "feedback"
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2
+
+
+def feedback_table_ddl(name: str) -> str:
+    return f"""
+            CREATE TABLE IF NOT EXISTS {name} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                input TEXT NOT NULL,
+                output TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                create_time TIMESTAMP NOT NULL,
+                preference INTEGER,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            );
+            CREATE INDEX IF NOT EXISTS {name}_create_time_idx ON {name} (create_time);
+            CREATE INDEX IF NOT EXISTS {name}_user_id_idx ON {name} (user_id);
+    """
+
 
 class Database:
+    FEEDBACK_ID_BLOCK_SIZE = 1000
+
     def __init__(self, conn: aiosqlite.Connection):
         self.conn = conn
         self.lock = asyncio.Lock()
         self.conn.row_factory = aiosqlite.Row
+        self.feedback_partitions: list[str] = []
+        self.feedback_id_allocator = FeedbackIdAllocator(
+            self._reserve_feedback_id_block, self.FEEDBACK_ID_BLOCK_SIZE)
+        self.feedback_batcher = FeedbackBatcher(
+            self._write_feedback_rows, self._write_feedback_preferences)
 
     @classmethod
     async def create_and_connect(cls, dsn: str, timeout=60, **kwargs):
@@ -25,15 +59,31 @@ class Database:
             raise
 
         db = cls(conn)
+        await db.enable_incremental_vacuum()
         await db.create_tables()
+        await db.ensure_feedback_partitions(datetime.now())
         return db
 
     async def close(self):
         """Closes the SQLite connection."""
+        await self.feedback_batcher.close()
         if self.conn:
             await self.conn.close()
             logger.info("SQLite connection closed.")
 
+    async def enable_incremental_vacuum(self):
+        """Switch to incremental auto-vacuum, so pages freed by dropped partitions can be returned to the OS.
+
+        An existing database has to be rebuilt once with VACUUM for the mode to take effect.
+        """
+        async with self.lock:
+            cursor = await self.conn.execute("PRAGMA auto_vacuum")
+            if (await cursor.fetchone())[0] == SQLITE_AUTO_VACUUM_INCREMENTAL:
+                return
+            logger.info("Switching SQLite to incremental auto-vacuum; rebuilding the database once.")
+            await self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await self.conn.execute("VACUUM")
+
     async def create_tables(self):
         """Create required tables if they do not exist."""
         async with self.lock:
@@ -54,21 +104,40 @@ class Database:
                 last_use TIMESTAMP,
                 first_use TIMESTAMP
             );
-            CREATE TABLE IF NOT EXISTS feedback (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                input TEXT NOT NULL,
-                output TEXT NOT NULL,
+            """ + feedback_table_ddl(LEGACY_FEEDBACK_TABLE) + """
+            CREATE TABLE IF NOT EXISTS id_blocks (
+                name TEXT PRIMARY KEY,
+                next_id INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO id_blocks (name, next_id)
+                SELECT 'feedback', COALESCE(MAX(id), 0) + 1 FROM feedback;
+            CREATE TABLE IF NOT EXISTS usage_daily (
+                day DATE NOT NULL,
+                chat_id TEXT NOT NULL,
+                messages INTEGER NOT NULL DEFAULT 0,
+                help_requests INTEGER NOT NULL DEFAULT 0,
+                active_users INTEGER NOT NULL DEFAULT 0,
+                feedback INTEGER NOT NULL DEFAULT 0,
+                likes INTEGER NOT NULL DEFAULT 0,
+                dislikes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, chat_id)
+            );
+            CREATE TABLE IF NOT EXISTS daily_active_users (
+                day DATE NOT NULL,
                 user_id TEXT NOT NULL,
-                create_time TIMESTAMP NOT NULL,
-                preference INTEGER,
-                FOREIGN KEY(user_id) REFERENCES users(id)
+                PRIMARY KEY (day, user_id)
             );
             """)
             await self.conn.commit()
+
+            cursor = await self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?", (FEEDBACK_PARTITION_PREFIX + '%',))
+            self.feedback_partitions = sorted(row[0] for row in await cursor.fetchall())
         logger.info("Database tables created or verified successfully.")
 
     # --- User Methods ---
 
+    @traced("db.upsert_user")
     async def upsert_user(self, user_id: str, help_count_inc: int = 0, block: bool = None, last_block: datetime = None, msg_count_inc: int = 0, last_use: datetime = None, first_use: datetime = None):
         """Inserts a new user or updates an existing one using ON CONFLICT."""
         query = """
@@ -77,21 +146,26 @@ class Database:
             ON CONFLICT(id) DO UPDATE SET
                 help_count = help_count + excluded.help_count,
                 msg_count = msg_count + excluded.msg_count,
-                last_use = COALESCE(excluded.last_use, last_use),
+                last_use = COALESCE(?, last_use),
                 block = COALESCE(excluded.block, block),
                 last_block = COALESCE(excluded.last_block, last_block);
         """
+        # excluded.last_use falls back to first_use, so an update only sets last_use when given one
         params = (
             user_id, help_count_inc, block, last_block, msg_count_inc,
-            last_use, first_use, first_use, last_use
+            last_use, first_use, first_use, last_use,
+            last_use
         )
         async with self.lock:
             cursor = await self.conn.execute(query, params)
+            if msg_count_inc or help_count_inc:
+                await self._record_user_activity(user_id, usage_day(last_use, first_use), msg_count_inc, help_count_inc)
             await self.conn.commit()
-        logger.debug(f"Upserted user: {user_id}")
+        logger.debug("Upserted user: %s", user_id)
 
     # --- Group Methods ---
 
+    @traced("db.upsert_group")
     async def upsert_group(self, group_id: str, leave: bool = None, msg_count_inc: int = 0, last_use: datetime = None, first_use: datetime = None):
         """Inserts a new group or updates an existing one using ON CONFLICT."""
         query = """
@@ -100,36 +174,199 @@ class Database:
             ON CONFLICT(id) DO UPDATE SET
                 leave = COALESCE(excluded.leave, leave),
                 msg_count = msg_count + excluded.msg_count,
-                last_use = COALESCE(excluded.last_use, last_use);
+                last_use = COALESCE(?, last_use);
         """
+        # excluded.last_use falls back to first_use, so an update only sets last_use when given one
         params = (
             group_id, leave, msg_count_inc,
-            last_use, first_use, first_use, last_use
+            last_use, first_use, first_use, last_use,
+            last_use
         )
         async with self.lock:
             await self.conn.execute(query, params)
+            if msg_count_inc:
+                await self._increment_usage(usage_day(last_use, first_use), group_id, messages=msg_count_inc)
             await self.conn.commit()
-        logger.debug(f"Upserted group: {group_id}")
+        logger.debug("Upserted group: %s", group_id)
 
     # --- Feedback Methods ---
 
-    async def insert_feedback(self, input_text: str, output_text: str, user_id: str, create_time: datetime) -> int:
-        """Inserts a new feedback entry and returns its ID."""
-        query = "INSERT INTO feedback (input, output, user_id, create_time) VALUES (?, ?, ?, ?)"
-        params = (input_text, output_text, user_id, create_time)
+    async def _reserve_feedback_id_block(self, block_size: int) -> int:
+        query = "UPDATE id_blocks SET next_id = next_id + ? WHERE name = 'feedback' RETURNING next_id - ?"
+        async with self.lock:
+            cursor = await self.conn.execute(query, (block_size, block_size))
+            row = await cursor.fetchone()
+            await self.conn.commit()
+        return row[0]
+
+    @traced("db.allocate_feedback_id")
+    async def allocate_feedback_id(self) -> int:
+        """Returns a feedback id that can be used before its row is inserted."""
+        return await self.feedback_id_allocator.allocate()
+
+    @traced("db.insert_feedback")
+    async def insert_feedback(self, feedback_id: int, input_text: str, output_text: str, user_id: str, create_time: datetime):
+        """Queues a new feedback entry; it is written with the next batch."""
+        self.feedback_batcher.add(
+            feedback_id, input_text, output_text, user_id, create_time)
+
+    @traced("db.write_feedback_rows")
+    async def _write_feedback_rows(self, rows: list[tuple]):
+        rows_by_partition: dict[str, list[tuple]] = {}
+        for row in rows:
+            rows_by_partition.setdefault(
+                feedback_partition_name(row[4]), []).append(row)
 
         async with self.lock:
-            cursor = await self.conn.execute(query, params)
+            for name, partition_rows in rows_by_partition.items():
+                await self._create_feedback_partition(name)
+                query = f"INSERT INTO {name} (id, input, output, user_id, create_time, preference) VALUES (?, ?, ?, ?, ?, ?)"
+                await self.conn.executemany(query, partition_rows)
+            for day, count in Counter(row[4].date() for row in rows).items():
+                await self._increment_usage(day, USAGE_ALL_CHATS, feedback=count)
             await self.conn.commit()
-            return cursor.lastrowid
 
-    async def update_feedback_preference(self, feedback_id: int, preference: int):
-        """Updates the preference for a feedback entry."""
-        query = "UPDATE feedback SET preference = ? WHERE id = ?"
-        params = (preference, feedback_id)
+    @traced("db.write_feedback_preferences")
+    async def _write_feedback_preferences(self, preferences: list[tuple[int, int]]):
+        async with self.lock:
+            for feedback_id, preference in preferences:
+                await self._update_feedback_preference(feedback_id, preference)
+            await self.conn.commit()
+
+    async def _update_feedback_preference(self, feedback_id: int, preference: int):
+        # Feedback is usually rated shortly after it is created, so search the newest partitions first
+        for name in reversed(self.feedback_partitions + [LEGACY_FEEDBACK_TABLE]):
+            cursor = await self.conn.execute(
+                f"UPDATE {name} SET preference = ? WHERE id = ?", (preference, feedback_id))
+            if cursor.rowcount > 0:
+                return
+
+    async def _find_feedback(self, feedback_id: int) -> tuple[str, datetime, int] | None:
+        """Returns the table holding a feedback row, its create_time and its preference."""
+        for name in reversed(self.feedback_partitions + [LEGACY_FEEDBACK_TABLE]):
+            cursor = await self.conn.execute(
+                f"SELECT create_time, preference FROM {name} WHERE id = ?", (feedback_id,))
+            row = await cursor.fetchone()
+            if row is not None:
+                return name, datetime.fromisoformat(row[0]), row[1]
+        return None
 
+    @traced("db.update_feedback_preference")
+    async def update_feedback_preference(self, feedback_id: int, preference: int, group_id: str = None):
+        """Updates the preference for a feedback entry, which may still be queued.
+
+        The vote is rolled up under the feedback's day, for all chats and for `group_id`, if the preference changed.
+        """
         async with self.lock:
-            await self.conn.execute(query, params)
+            queued = self.feedback_batcher.set_preference(feedback_id, preference)
+            if queued is not None:
+                create_time, previous = queued
+            else:
+                found = await self._find_feedback(feedback_id)
+                if found is None:
+                    logger.warning(f"No feedback {feedback_id} to set preference {preference} on")
+                    return
+                name, create_time, previous = found
+                if previous != preference:
+                    await self.conn.execute(
+                        f"UPDATE {name} SET preference = ? WHERE id = ?", (preference, feedback_id))
+            counters = vote_counters(previous, preference)
+            if counters:
+                for chat_id in (USAGE_ALL_CHATS, group_id) if group_id else (USAGE_ALL_CHATS,):
+                    await self._increment_usage(create_time.date(), chat_id, **counters)
+            await self.conn.commit()
+        logger.debug("Updated feedback %d with preference %d",
+                     feedback_id, preference)
+
+    # --- Usage Rollup Methods ---
+
+    async def _increment_usage(self, day: date, chat_id: str, **counters: int):
+        """Adds to the usage_daily counters; the caller holds the lock and commits."""
+        columns = [name for name in USAGE_COUNTERS if name in counters]
+        query = f"""
+            INSERT INTO usage_daily (day, chat_id, {', '.join(columns)})
+            VALUES (?, ?, {', '.join('?' for _ in columns)})
+            ON CONFLICT(day, chat_id) DO UPDATE SET
+                {', '.join(f'{name} = {name} + excluded.{name}' for name in columns)};
+        """
+        await self.conn.execute(query, (day, chat_id, *(counters[name] for name in columns)))
+
+    async def _record_user_activity(self, user_id: str, day: date, msg_count_inc: int, help_count_inc: int):
+        cursor = await self.conn.execute(
+            "INSERT OR IGNORE INTO daily_active_users (day, user_id) VALUES (?, ?)", (day, user_id))
+        await self._increment_usage(
+            day, USAGE_ALL_CHATS,
+            messages=msg_count_inc,
+            help_requests=help_count_inc,
+            active_users=cursor.rowcount,
+        )
+
+    async def prune_daily_active_users(self, before: date):
+        """Drops the per-user rows only needed to count a day's distinct active users."""
+        async with self.lock:
+            await self.conn.execute("DELETE FROM daily_active_users WHERE day < ?", (before,))
+            await self.conn.commit()
+
+    async def get_usage_stats(self, day: date, chat_id: str = USAGE_ALL_CHATS) -> dict[str, int]:
+        """Returns the rolled up counters of one chat (or all chats) on one day."""
+        query = f"SELECT {', '.join(USAGE_COUNTERS)} FROM usage_daily WHERE day = ? AND chat_id = ?"
+        async with self.lock:
+            cursor = await self.conn.execute(query, (day, chat_id))
+            row = await cursor.fetchone()
+        if row is None:
+            return dict.fromkeys(USAGE_COUNTERS, 0)
+        return dict(zip(USAGE_COUNTERS, row))
+
+    # --- Feedback Partition Methods ---
+
+    async def _create_feedback_partition(self, name: str):
+        if name in self.feedback_partitions:
+            return
+        await self.conn.executescript(feedback_table_ddl(name))
+        self.feedback_partitions = sorted(self.feedback_partitions + [name])
+        logger.info(f"Created feedback partition {name}")
+
+    async def ensure_feedback_partitions(self, now: datetime):
+        """Create the partitions for the current and the next month."""
+        async with self.lock:
+            for start in (month_start(now), next_month_start(now)):
+                await self._create_feedback_partition(feedback_partition_name(start))
+            await self.conn.commit()
+
+    async def list_feedback_partitions(self) -> list[tuple[str, datetime]]:
+        """Returns (partition name, exclusive create_time upper bound) pairs, oldest first.
+
+        The legacy feedback table is listed first, bounded by its newest row, while it holds any rows.
+        """
+        partitions = []
+        async with self.lock:
+            cursor = await self.conn.execute(f"SELECT MAX(create_time) FROM {LEGACY_FEEDBACK_TABLE}")
+            legacy_max_time = (await cursor.fetchone())[0]
+        if legacy_max_time is not None:
+            partitions.append(
+                (LEGACY_FEEDBACK_TABLE, datetime.fromisoformat(legacy_max_time)))
+        partitions.extend((name, feedback_partition_upper_bound(name))
+                          for name in self.feedback_partitions)
+        return partitions
+
+    async def read_feedback_partition(self, name: str, after_id: int, limit: int) -> list[tuple]:
+        """Reads up to `limit` rows of a partition with id greater than `after_id`, ordered by id."""
+        query = f"SELECT id, input, output, user_id, create_time, preference FROM {name} WHERE id > ? ORDER BY id LIMIT ?"
+        async with self.lock:
+            cursor = await self.conn.execute(query, (after_id, limit))
+            rows = await cursor.fetchall()
+        return [tuple(row) for row in rows]
+
+    async def drop_feedback_partition(self, name: str):
+        """Drops a partition. The legacy table is recreated empty so preference lookups keep working."""
+        async with self.lock:
+            await self.conn.execute(f"DROP TABLE {name}")
+            if name == LEGACY_FEEDBACK_TABLE:
+                await self.conn.executescript(feedback_table_ddl(LEGACY_FEEDBACK_TABLE))
+            else:
+                self.feedback_partitions.remove(name)
             await self.conn.commit()
-        logger.debug(
-            f"Updated feedback {feedback_id} with preference {preference}")
+            # DROP TABLE only moves pages to the freelist. executescript steps the pragma to completion;
+            # execute would free a single page.
+            await self.conn.executescript("PRAGMA incremental_vacuum;")
+        logger.info(f"Dropped feedback partition {name}")
@@ -0,0 +1,244 @@
+'''
+Precomputed sentence -> emoji lexicon that lets `generate` skip the model for frequent short phrases.
+
+The lexicon is built offline from feedback rows, which hold every reply the bot generated along with
+the users' likes and dislikes, both from the database and from the Parquet exports. It is stored as an
+open-addressing hash table keyed by `sentence_key`, and mmap'ed read-only at start-up. Build it with:
+    python emoji_lexicon.py --output ../data/emoji_lexicon.bin --export-dir ../data/feedback_export
+'''
+
+import asyncio
+import glob
+import logging
+import mmap
+import os
+import re
+import string
+import struct
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+
+import emoji
+from segmentation import URL_PATTERN
+from sentence_cache import normalize_sentence, sentence_key
+
+logger = logging.getLogger()
+
+LEXICON_MAGIC = b"EMJLEX01"
+# magic, slot count (a power of two), entry count, offset of the UTF-8 value blob
+HEADER = struct.Struct("<8sIIQ")
+# sentence key (0 marks an empty slot), value offset, value length
+SLOT = struct.Struct("<QIH2x")
+EMPTY_KEY = 0
+
+READ_CHUNK_SIZE = 5000
+LIKE_WEIGHT = 4
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+SEGMENT_EDGE_CHARACTERS = string.punctuation + string.whitespace + "，。？！；"
+
+
+def lexicon_key(text: str) -> int:
+    return sentence_key(text) or 1
+
+
+def write_lexicon(path: str, entries: dict[int, str]):
+    """Writes `entries` (lexicon key -> emoji) as a hash table at most half full."""
+    slot_count = 8
+    while slot_count < len(entries) * 2:
+        slot_count <<= 1
+    mask = slot_count - 1
+
+    slots = [(EMPTY_KEY, 0, 0)] * slot_count
+    values = bytearray()
+    for key, value in entries.items():
+        encoded = value.encode()
+        index = key & mask
+        while slots[index][0] != EMPTY_KEY:
+            index = (index + 1) & mask
+        slots[index] = (key, len(values), len(encoded))
+        values += encoded
+
+    values_offset = HEADER.size + SLOT.size * slot_count
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(LEXICON_MAGIC, slot_count, len(entries), values_offset))
+        for slot in slots:
+            f.write(SLOT.pack(*slot))
+        f.write(values)
+    os.replace(tmp_path, path)
+
+
+class EmojiLexicon:
+    """Read-only view of a lexicon file; lookups read the mmap'ed table directly."""
+
+    def __init__(self, buffer: mmap.mmap, path: str):
+        self.buffer = buffer
+        self.path = path
+        magic, self.slot_count, self.entry_count, self.values_offset = HEADER.unpack_from(buffer, 0)
+        if magic != LEXICON_MAGIC:
+            raise ValueError(f"Not an emoji lexicon: {path}")
+        self.mask = self.slot_count - 1
+        self.counters = Counter()
+
+    @classmethod
+    def open(cls, path: str) -> 'EmojiLexicon':
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        lexicon = cls(buffer, path)
+        logger.info(f"Loaded emoji lexicon {path}: {lexicon.entry_count} phrases")
+        return lexicon
+
+    def __len__(self):
+        return self.entry_count
+
+    def get(self, text: str) -> str:
+        """Returns the emoji for a sentence, or None if the lexicon does not cover it."""
+        key = lexicon_key(text)
+        index = key & self.mask
+        while True:
+            slot_key, value_offset, value_length = SLOT.unpack_from(
+                self.buffer, HEADER.size + SLOT.size * index)
+            if slot_key == key:
+                self.counters["hits"] += 1
+                start = self.values_offset + value_offset
+                return self.buffer[start:start + value_length].decode()
+            if slot_key == EMPTY_KEY:
+                self.counters["misses"] += 1
+                return None
+            index = (index + 1) & self.mask
+
+    def stats(self) -> dict:
+        return {"entries": self.entry_count, **self.counters}
+
+    def close(self):
+        self.buffer.close()
+
+
+def split_reply(input_text: str, output_text: str) -> list[tuple[str, str]]:
+    """Recovers (sentence, emoji) pairs from a stored reply, whichever segmentation produced it.
+
+    Each run of emoji closes the sentence or clause before it. Replies whose text is not the
+    input, e.g. the "too long" message, and inputs that contain emoji themselves yield nothing.
+    """
+    if any(emoji.is_emoji(char) for char in input_text):
+        return []
+    reply_text = "".join(char for char in output_text if not emoji.is_emoji(char))
+    if WHITESPACE_PATTERN.sub("", reply_text) != WHITESPACE_PATTERN.sub("", URL_PATTERN.sub("", input_text)):
+        return []
+
+    pairs = []
+    segment_start = 0
+    position = 0
+    while position < len(output_text):
+        if not emoji.is_emoji(output_text[position]):
+            position += 1
+            continue
+        end = position
+        while end < len(output_text) and emoji.is_emoji(output_text[end]):
+            end += 1
+        # The segment starts with the previous sentence's delimiter
+        sentence = output_text[segment_start:position].strip(SEGMENT_EDGE_CHARACTERS)
+        if sentence:
+            pairs.append((sentence, output_text[position:end]))
+        segment_start = position = end
+    return pairs
+
+
+class LexiconBuilder:
+    """Votes for each short sentence's emoji; a liked reply counts as `1 + LIKE_WEIGHT` votes, a disliked one as `-LIKE_WEIGHT`."""
+
+    def __init__(self, max_sentence_length: int = 20, min_score: int = 3, max_entries: int = 100000):
+        self.max_sentence_length = max_sentence_length
+        self.min_score = min_score
+        self.max_entries = max_entries
+        self.votes: defaultdict[int, Counter] = defaultdict(Counter)
+        self.rows = 0
+
+    def add_row(self, input_text: str, output_text: str, preference: int):
+        self.rows += 1
+        if preference is not None and preference < 0:
+            weight = -LIKE_WEIGHT
+        elif preference is not None and preference > 0:
+            weight = 1 + LIKE_WEIGHT
+        else:
+            weight = 1
+        for sentence, emojis in split_reply(input_text, output_text):
+            if emojis and len(normalize_sentence(sentence)) <= self.max_sentence_length:
+                self.votes[lexicon_key(sentence)][emojis] += weight
+
+    def entries(self) -> dict[int, str]:
+        scored = []
+        for key, votes in self.votes.items():
+            emojis, score = votes.most_common(1)[0]
+            if score >= self.min_score:
+                scored.append((score, key, emojis))
+        scored.sort(reverse=True)
+        return {key: emojis for _, key, emojis in scored[:self.max_entries]}
+
+
+async def read_feedback_from_db(db, builder: LexiconBuilder):
+    for name, _ in await db.list_feedback_partitions():
+        last_id = 0
+        while True:
+            rows = await db.read_feedback_partition(name, after_id=last_id, limit=READ_CHUNK_SIZE)
+            if not rows:
+                break
+            for _, input_text, output_text, _, _, preference in rows:
+                builder.add_row(input_text, output_text, preference)
+            last_id = rows[-1][0]
+
+
+def read_feedback_from_parquet(export_dir: str, builder: LexiconBuilder):
+    import pyarrow.parquet as pq
+
+    for path in sorted(glob.glob(os.path.join(export_dir, "*.parquet"))):
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=READ_CHUNK_SIZE, columns=["input", "output", "preference"]):
+            columns = batch.to_pydict()
+            for row in zip(columns["input"], columns["output"], columns["preference"]):
+                builder.add_row(*row)
+
+
+async def main(args):
+    logging.basicConfig(level=logging.INFO)
+    builder = LexiconBuilder(
+        max_sentence_length=args.max_sentence_length,
+        min_score=args.min_score,
+        max_entries=args.max_entries,
+    )
+
+    if args.export_dir is not None and os.path.isdir(args.export_dir):
+        await asyncio.to_thread(read_feedback_from_parquet, args.export_dir, builder)
+
+    if args.dsn is None:
+        from db_sqlite import Database
+        dsn = "../data/emojilm.db"
+    else:
+        from db_pg import Database
+        dsn = args.dsn
+    db = await Database.create_and_connect(dsn=dsn)
+    try:
+        await read_feedback_from_db(db, builder)
+    finally:
+        await db.close()
+
+    entries = builder.entries()
+    write_lexicon(args.output, entries)
+    print(f"Read {builder.rows} feedback rows, {len(builder.votes)} distinct short sentences; "
+          f"wrote {len(entries)} phrases to {args.output}")
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--dsn', default=os.getenv('POSTGRES_DSN', None))
+    parser.add_argument('--export-dir', default="../data/feedback_export")
+    parser.add_argument('--output', default="../data/emoji_lexicon.bin")
+    parser.add_argument('--max-sentence-length', type=int, default=20)
+    parser.add_argument('--min-score', type=int, default=3)
+    parser.add_argument('--max-entries', type=int, default=100000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
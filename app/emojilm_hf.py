@@ -4,7 +4,6 @@ This module generates emojis using the huggingface inference API.
 '''
 
 import asyncio
-import itertools
 import logging
 import random
 import re
@@ -13,14 +12,11 @@ import time
 from asyncio import Semaphore
 
 import aiohttp
-import fasttext
-import nltk
-from async_lru import alru_cache
+from emojilm_openai import EmojiLmBase
 
 logger = logging.getLogger()
-language_model = fasttext.load_model("lid.176.ftz")
 
-class EmojiLmHf:
+class EmojiLmHf(EmojiLmBase):
     KEEP_ALIVE_STR = "👋"
     API_URL = "https://api-inference.huggingface.co/models/liswei/EmojiLMSeq2SeqLoRA"
     SENTENCE_LIMIT = 99
@@ -31,7 +27,9 @@ class EmojiLmHf:
         hf_api_token_list,
         concurrency=3,
         keep_alive_interval=300,  # seconds
+        cache_bytes=1024 * 1024,
     ):
+        super().__init__(self.SENTENCE_LIMIT, cache_bytes=cache_bytes)
         self.hf_api_token_list = hf_api_token_list
         self.query_semaphore = Semaphore(concurrency)
         self.keep_alive_interval = keep_alive_interval
@@ -57,9 +55,7 @@ class EmojiLmHf:
             random_str = ''.join(random.choices(
                 string.ascii_letters + string.digits, k=2))
             query_value = self.KEEP_ALIVE_STR + random_str
-            await self.query(query_value)
-            if hasattr(self.query, "cache_invalidate"):
-                self.query.cache_invalidate(query_value)
+            await self._query(query_value)
 
         while True:
             async with self.last_query_time_lock:
@@ -78,41 +74,10 @@ class EmojiLmHf:
             async with self.last_query_time_lock:
                 self.last_query_time = current_time
 
-    async def generate(self, input_text):
-        text_list, delimiter_list = preprocess_input_text(input_text)
-        logger.debug(f"Text list length: {len(text_list)}")
-
-        if len(text_list) > self.SENTENCE_LIMIT:
-            logger.warning(f"Input text too long: {len(text_list)}")
-            last_sentence_within_limit = text_list[self.SENTENCE_LIMIT-1]
-            if len(last_sentence_within_limit) >= 5:
-                last_sentence_within_limit = '...' + \
-                    last_sentence_within_limit[-5:]
-            return f"太長了啦❗️ 你輸入了{len(text_list)}句 目前限制{self.SENTENCE_LIMIT}句話 大概到這邊而已：「{last_sentence_within_limit}」", []
-
-        emojis = await asyncio.gather(*(self.query(self.INPUT_PREFIX + t) for t in text_list))
-
-        output_list = list(itertools.chain.from_iterable(
-            zip(text_list, emojis, delimiter_list)))
-        min_length = min(len(text_list), len(
-            emojis), len(delimiter_list))
-        if len(text_list) > min_length:
-            output_list.extend(text_list[min_length:])
-        if len(emojis) > min_length:
-            output_list.extend(emojis[min_length:])
-        if len(delimiter_list) > min_length:
-            output_list.extend(delimiter_list[min_length:])
-
-        output = "".join(output_list)
-
-        output_emoji_set = set()
-        for e in emojis:
-            output_emoji_set = output_emoji_set.union(set(e))
-
-        return output, output_emoji_set
-
-    @alru_cache(maxsize=1024)
     async def query(self, input_text):
+        return await self.cache.get_or_load(input_text, lambda: self._query(self.INPUT_PREFIX + input_text))
+
+    async def _query(self, input_text):
         logger.debug(f"Query: {input_text}")
         payload = {
             "inputs": input_text,
@@ -148,40 +113,6 @@ class EmojiLmHf:
         await self.aio_session.close()
 
 
-def preprocess_input_text(input_text: str):
-    input_text = re.sub(r"https?://\S+|www\.\S+", "", input_text)
-    language_label = language_model.predict(
-        [input_text.replace("\n", "")])[0][0][0]
-    if language_label in ['__label__zh', '__label__ja', '__label__ko']:
-        input_text = input_text.strip(" \n")
-        parts = re.split(r'([ ，,。.？?！!;\n\s]+)', input_text)
-        sentence_list = parts[::2]
-        delimiter_list = parts[1::2]
-
-        while len(sentence_list) > 0 and sentence_list[-1] == '':
-            sentence_list.pop()
-            if len(delimiter_list) > len(sentence_list):
-                delimiter_list.pop()
-        delimiter_list += [''] * (len(sentence_list) - len(delimiter_list))
-        return sentence_list, delimiter_list
-    else:
-        sentences = nltk.tokenize.sent_tokenize(input_text, language='english')
-        delimiter_list = []
-        # Regular expression to match trailing punctuation
-        pattern = re.compile(r'([^\w\s]+)$')
-
-        cleaned_sentences = []
-        for sentence in sentences:
-            match = pattern.search(sentence)
-            if match:
-                delimiter_list.append(match.group(1))  # Extract punctuation
-                sentence = sentence[:match.start()]   # Remove punctuation
-            else:
-                delimiter_list.append("")
-            cleaned_sentences.append(sentence)
-        return cleaned_sentences, delimiter_list
-
-
 def post_process_output(output_emoji: str):
     if re.match(r"<(.*?)>", output_emoji):
         try:
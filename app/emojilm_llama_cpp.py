@@ -0,0 +1,120 @@
+'''
+This module generates emojis with the GGUF weights loaded in-process through llama-cpp-python,
+avoiding the HTTP hop to a separate llama.cpp server. Sentences are decoded together, each in its
+own sequence, and join the running batch at the next decode step (see llama_decoder.py).
+'''
+
+import asyncio
+import itertools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from emojilm_openai import EmojiLmBase, post_process_output
+from llama_decoder import LlamaBatchDecoder
+from logging_utils import SAMPLED
+from segmentation import DEFAULT_MAX_CLAUSE_LENGTH
+from sentence_cache import DEFAULT_CACHE_BYTES
+from tracing import tracer
+
+logger = logging.getLogger()
+
+
+class EmojiLmLlamaCpp(EmojiLmBase):
+
+    def __init__(self, decoder, sentence_limit, cache_bytes=DEFAULT_CACHE_BYTES, lexicon=None,
+                 min_clause_length=0, max_clause_length=DEFAULT_MAX_CLAUSE_LENGTH):
+        super().__init__(sentence_limit, cache_bytes=cache_bytes, lexicon=lexicon,
+                         min_clause_length=min_clause_length, max_clause_length=max_clause_length)
+        self.decoder = decoder
+
+        # llama.cpp is not thread safe, so every decode step runs on this single worker thread.
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="llama-cpp")
+        self.pending_queue: asyncio.Queue[tuple[str, asyncio.Future]] = asyncio.Queue()
+        self.batch_task = asyncio.create_task(self._batch_worker())
+
+    @classmethod
+    async def create(
+        cls,
+        model_path,
+        sentence_limit,
+        max_batch_size=32,
+        n_ctx_per_seq=128,
+        n_threads=None,
+        cache_bytes=DEFAULT_CACHE_BYTES,
+        lexicon=None,
+        min_clause_length=0,
+        max_clause_length=DEFAULT_MAX_CLAUSE_LENGTH,
+    ):
+        if not model_path:
+            raise ValueError("LLAMA_CPP_MODEL_PATH must point to a GGUF file for the llama_cpp backend")
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"GGUF model not found: {model_path}")
+
+        loop = asyncio.get_running_loop()
+        decoder = await loop.run_in_executor(None, lambda: LlamaBatchDecoder(
+            model_path,
+            n_seq_max=max_batch_size,
+            n_ctx_per_seq=n_ctx_per_seq,
+            n_threads=n_threads,
+        ))
+        return cls(decoder, sentence_limit, cache_bytes=cache_bytes, lexicon=lexicon,
+                   min_clause_length=min_clause_length, max_clause_length=max_clause_length)
+
+    async def query(self, input_text):
+        return await self.cache.get_or_load(input_text, lambda: self._query(input_text))
+
+    async def _query(self, input_text):
+        logger.debug("Query: %s", input_text)
+        with tracer.span("query", input_length=len(input_text)):
+            future = asyncio.get_running_loop().create_future()
+            await self.pending_queue.put((input_text, future))
+            ret = await future
+
+        ret = post_process_output(ret)
+        logger.info("Input: `%s` Output: `%s`", input_text, ret, extra=SAMPLED)
+        return ret
+
+    async def _batch_worker(self):
+        """Runs decode steps while sentences are in flight, admitting queued ones as sequences free up."""
+        loop = asyncio.get_running_loop()
+        request_ids = itertools.count()
+        in_flight: dict[int, asyncio.Future] = {}
+        while True:
+            queued = []
+            if self.decoder.idle:
+                queued.append(await self.pending_queue.get())
+            while len(queued) < self.decoder.free_slots and not self.pending_queue.empty():
+                queued.append(self.pending_queue.get_nowait())
+
+            new_prompts = []
+            for prompt, future in queued:
+                request_id = next(request_ids)
+                in_flight[request_id] = future
+                new_prompts.append((request_id, prompt))
+
+            try:
+                finished = await loop.run_in_executor(self.executor, self.decoder.step, new_prompts)
+            except Exception as e:
+                logger.exception(e)
+                await loop.run_in_executor(self.executor, self.decoder.reset)
+                for future in in_flight.values():
+                    if not future.done():
+                        future.set_exception(e)
+                in_flight.clear()
+                continue
+
+            for request_id, output in finished:
+                future = in_flight.pop(request_id)
+                if not future.done():
+                    future.set_result(output)
+
+    async def close(self):
+        self.batch_task.cancel()
+        try:
+            await self.batch_task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+        self.decoder.close()
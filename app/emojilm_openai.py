@@ -2,47 +2,91 @@ import asyncio
 import itertools
 import logging
 import re
+import time
 from asyncio import Semaphore
+from collections import Counter
 from urllib.parse import urljoin
 
-import aiohttp
 import emoji
 import fasttext
 import nltk
-from async_lru import alru_cache
+import orjson
+from http_transport import create_client_session
+from logging_utils import SAMPLED
+from near_duplicate import DEFAULT_MAX_SENTENCE_LENGTH, NearDuplicateIndex
+from segmentation import (DEFAULT_MAX_CLAUSE_LENGTH, URL_PATTERN,
+                          coalesce_fragments, split_cjk)
+from sentence_cache import DEFAULT_CACHE_BYTES, SentenceCache
+from tracing import tracer
 
 logger = logging.getLogger()
 language_model = fasttext.load_model("lid.176.ftz")
 
 
-class EmojiLmOpenAi:
+QUALITY_TIER = "quality"
+FAST_TIER = "fast"
 
-    def __init__(self, OPENAI_API_URL, OPENAI_API_KEY, aio_session, model_id, concurrency, sentence_limit):
+
+class CompletionBackend:
+    """One llama.cpp server speaking the OpenAI completions API, e.g. the f16 or the q8_0 model."""
+
+    LATENCY_EWMA_ALPHA = 0.2
+
+    def __init__(self, tier, OPENAI_API_URL, OPENAI_API_KEY, aio_session, model_id, concurrency):
+        self.tier = tier
         self.OPENAI_API_URL = OPENAI_API_URL
         self.api_key = OPENAI_API_KEY
-        self.SENTENCE_LIMIT = sentence_limit
 
         self.query_semaphore = Semaphore(concurrency)
         self.aio_session = aio_session
         self.model_id = model_id
+        self.concurrency = concurrency
+
+        # Load signals used for tier routing
+        self.pending = 0
+        self.latency_ewma = 0.0
+
+        # Built once so the hot path only has to fill in the prompt
+        self.completions_url = urljoin(self.OPENAI_API_URL, "v1/completions")
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        self.payload_template = {
+            "model": self.model_id,
+            "max_tokens": 5,
+            "temperature": 0.3,
+            "frequency_penalty": 1.1,
+            "top_p": 0.7,
+            "stop": ["\n", "\t", " ", '.'],
+        }
 
     @classmethod
     async def create(
         cls,
+        tier,
         OPENAI_API_URL,
         OPENAI_API_KEY,
         concurrency,
-        sentence_limit,
+        keepalive_timeout=60,
+        connect_timeout=5,
+        read_timeout=30,
     ):
-        aio_session = aiohttp.ClientSession()
-        model_id = await cls._get_model_id(aio_session, OPENAI_API_URL, OPENAI_API_KEY)
-        return cls(OPENAI_API_URL, OPENAI_API_KEY, aio_session, model_id, concurrency, sentence_limit)
+        aio_session, base_url = create_client_session(
+            OPENAI_API_URL,
+            pool_size=concurrency,
+            keepalive_timeout=keepalive_timeout,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+        )
+        model_id = await cls._get_model_id(aio_session, base_url, OPENAI_API_KEY)
+        return cls(tier, base_url, OPENAI_API_KEY, aio_session, model_id, concurrency)
 
     @staticmethod
     async def _get_model_id(aio_session, OPENAI_API_URL, api_key):
         headers = {"Authorization": f"Bearer {api_key}"}
         async with aio_session.get(urljoin(OPENAI_API_URL, "v1/models"), headers=headers) as response:
-            resp = await response.json()
+            resp = orjson.loads(await response.read())
             if response.status != 200:
                 logger.error(f"Failed to get model id: {resp}")
                 raise Exception(f"Failed to get model id: {resp}")
@@ -56,9 +100,63 @@ class EmojiLmOpenAi:
             logger.info(f"Using model id: {model_id}")
             return model_id
 
-    async def generate(self, input_text):
-        sentence_list, delimiter_list = preprocess_input_text(input_text)
-        logger.debug(f"Text list length: {len(sentence_list)}")
+    async def complete(self, input_text):
+        payload = orjson.dumps({**self.payload_template, "prompt": input_text})
+
+        self.pending += 1
+        try:
+            with tracer.span("semaphore.wait", tier=self.tier):
+                await self.query_semaphore.acquire()
+            start = time.monotonic()
+            try:
+                try:
+                    with tracer.span("backend.request", tier=self.tier, attempt=1):
+                        async with self.aio_session.post(self.completions_url, headers=self.headers, data=payload) as response:
+                            resp = orjson.loads(await response.read())
+                            ret = resp['choices'][0]['text']
+                except Exception as e:
+                    logger.exception(e)
+                    # if we are able to get resp variable
+                    if 'resp' in locals():
+                        logger.info(f"Erroneous Response: {resp}")
+                    # retry once
+                    with tracer.span("backend.request", tier=self.tier, attempt=2):
+                        async with self.aio_session.post(self.completions_url, headers=self.headers, data=payload) as response:
+                            resp = orjson.loads(await response.read())
+                            ret = resp['choices'][0]['text']
+            finally:
+                self.query_semaphore.release()
+            self.latency_ewma += self.LATENCY_EWMA_ALPHA * \
+                (time.monotonic() - start - self.latency_ewma)
+        finally:
+            self.pending -= 1
+        return ret
+
+    async def close(self):
+        await self.aio_session.close()
+
+
+class EmojiLmBase:
+    """Splits a message into sentences, gets each sentence's emoji concurrently and puts the reply back together.
+
+    Backends only implement `query`, which returns the emojis for one sentence.
+    """
+
+    def __init__(self, sentence_limit, cache_bytes=DEFAULT_CACHE_BYTES, lexicon=None,
+                 min_clause_length=0, max_clause_length=DEFAULT_MAX_CLAUSE_LENGTH):
+        self.SENTENCE_LIMIT = sentence_limit
+        self.lexicon = lexicon
+        self.min_clause_length = min_clause_length
+        self.max_clause_length = max_clause_length
+        self.cache = SentenceCache(cache_bytes)
+
+    async def generate(self, input_text, lexicon_only=False):
+        """Adds emojis after each sentence; with `lexicon_only`, sentences the lexicon does not cover get none."""
+        with tracer.span("preprocess_input_text", input_length=len(input_text)) as span:
+            sentence_list, delimiter_list = preprocess_input_text(
+                input_text, self.min_clause_length, self.max_clause_length)
+            span.set_attribute("sentence_count", len(sentence_list))
+        logger.debug("Text list length: %d", len(sentence_list))
 
         if len(sentence_list) > self.SENTENCE_LIMIT:
             logger.warning(f"Input text too long: {len(sentence_list)}")
@@ -68,7 +166,7 @@ class EmojiLmOpenAi:
                     last_sentence_within_limit[-5:]
             return f"太長了啦❗️ 你輸入了{len(sentence_list)}句 目前限制{self.SENTENCE_LIMIT}句話 大概到這邊而已：「{last_sentence_within_limit}」", []
 
-        emojis = await asyncio.gather(*(self.query(sentence) for sentence in sentence_list))
+        emojis = await asyncio.gather(*(self.lexicon_or_query(sentence, lexicon_only) for sentence in sentence_list))
 
         output_list = list(itertools.chain.from_iterable(
             zip(sentence_list, emojis, delimiter_list)))
@@ -89,62 +187,173 @@ class EmojiLmOpenAi:
 
         return output, output_emoji_set
 
-    @alru_cache(maxsize=10240)
+    async def lexicon_or_query(self, input_text, lexicon_only=False):
+        if self.lexicon is not None:
+            ret = self.lexicon.get(input_text)
+            if ret is not None:
+                return ret
+        if lexicon_only:
+            return ""
+        return await self.query(input_text)
+
     async def query(self, input_text):
-        logger.debug(f"Query: {input_text}")
-        payload = {
-            "model": self.model_id,
-            "prompt": input_text,
-            "max_tokens": 5,
-            "temperature": 0.3,
-            "frequency_penalty": 1.1,
-            "top_p": 0.7,
-            "stop": ["\n", "\t", " ", '.'],
-        }
+        raise NotImplementedError
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+    def cache_clear(self):
+        self.cache.clear()
 
-        async with self.query_semaphore:
-            try:
-                async with self.aio_session.post(urljoin(self.OPENAI_API_URL, "v1/completions"), headers=headers, json=payload) as response:
-                    resp = await response.json()
-                    ret = resp['choices'][0]['text']
-            except Exception as e:
-                logger.exception(e)
-                # if we are able to get resp variable
-                if 'resp' in locals():
-                    logger.info(f"Erroneous Response: {resp}")
-                # retry once
-                async with self.aio_session.post(urljoin(self.OPENAI_API_URL, "v1/completions"), headers=headers, json=payload) as response:
-                    resp = await response.json()
-                    ret = resp['choices'][0]['text']
+    async def close(self):
+        pass
+
+
+class EmojiLmOpenAi(EmojiLmBase):
+    """Generates emojis through a quality backend (f16) and, optionally, a fast backend (q8_0).
+
+    Sentences go to the quality backend while it keeps up. Once its queue depth or latency
+    crosses the thresholds, new sentences go to the fast backend, and cached answers of
+    either tier are served. While routed away for latency, one sentence every
+    `QUALITY_PROBE_INTERVAL` seconds still goes to the quality backend, so its latency is
+    measured again and routing can switch back.
+    """
+
+    QUALITY_PROBE_INTERVAL = 5.0
+
+    def __init__(self, backends, sentence_limit, cache_bytes=DEFAULT_CACHE_BYTES, fast_queue_depth=None, fast_latency=None, lexicon=None, near_duplicates=None,
+                 min_clause_length=0, max_clause_length=DEFAULT_MAX_CLAUSE_LENGTH):
+        super().__init__(sentence_limit, cache_bytes=cache_bytes, lexicon=lexicon,
+                         min_clause_length=min_clause_length, max_clause_length=max_clause_length)
+        self.backends = backends
+        self.near_duplicates = near_duplicates
+
+        quality = self.backends[QUALITY_TIER]
+        self.fast_queue_depth = fast_queue_depth if fast_queue_depth is not None else quality.concurrency
+        self.fast_latency = fast_latency
+        self.last_quality_probe = 0.0
+
+        # The sentence cache is namespaced by tier
+        self.tier_stats = Counter()
+
+    @classmethod
+    async def create(
+        cls,
+        OPENAI_API_URL,
+        OPENAI_API_KEY,
+        concurrency,
+        sentence_limit,
+        keepalive_timeout=60,
+        connect_timeout=5,
+        read_timeout=30,
+        FAST_OPENAI_API_URL=None,
+        fast_queue_depth=None,
+        fast_latency=None,
+        cache_bytes=DEFAULT_CACHE_BYTES,
+        lexicon=None,
+        near_duplicate_threshold=None,
+        near_duplicate_max_entries=20000,
+        near_duplicate_max_length=DEFAULT_MAX_SENTENCE_LENGTH,
+        min_clause_length=0,
+        max_clause_length=DEFAULT_MAX_CLAUSE_LENGTH,
+    ):
+        urls = {QUALITY_TIER: OPENAI_API_URL}
+        if FAST_OPENAI_API_URL:
+            urls[FAST_TIER] = FAST_OPENAI_API_URL
+
+        backends = {}
+        for tier, url in urls.items():
+            backends[tier] = await CompletionBackend.create(
+                tier, url, OPENAI_API_KEY, concurrency,
+                keepalive_timeout=keepalive_timeout,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+            )
+        near_duplicates = None
+        if near_duplicate_threshold is not None:
+            near_duplicates = NearDuplicateIndex(
+                threshold=near_duplicate_threshold, max_entries=near_duplicate_max_entries,
+                max_length=near_duplicate_max_length)
+        return cls(backends, sentence_limit, cache_bytes=cache_bytes,
+                   fast_queue_depth=fast_queue_depth, fast_latency=fast_latency,
+                   lexicon=lexicon, near_duplicates=near_duplicates,
+                   min_clause_length=min_clause_length, max_clause_length=max_clause_length)
+
+    def under_load(self):
+        if FAST_TIER not in self.backends:
+            return False
+        quality = self.backends[QUALITY_TIER]
+        if quality.pending >= self.fast_queue_depth:
+            return True
+        return self.fast_latency is not None and quality.latency_ewma >= self.fast_latency
+
+    def _quality_probe_due(self):
+        # Only the quality backend's own requests move its latency EWMA
+        quality = self.backends[QUALITY_TIER]
+        if quality.pending >= self.fast_queue_depth:
+            return False
+        now = time.monotonic()
+        if now - self.last_quality_probe < self.QUALITY_PROBE_INTERVAL:
+            return False
+        self.last_quality_probe = now
+        return True
+
+    async def query(self, input_text):
+        under_load = self.under_load()
+        # Under load a warm answer from either tier beats waiting for the quality model
+        if under_load:
+            ret = self.cache.get(input_text, namespace=QUALITY_TIER, count_miss=False)
+            if ret is not None:
+                self.tier_stats[f"cache_hit_{QUALITY_TIER}"] += 1
+                return ret
+
+        tier = FAST_TIER if under_load else QUALITY_TIER
+        if under_load and self._quality_probe_due():
+            tier = QUALITY_TIER
+            self.tier_stats["quality_probes"] += 1
+        return await self.cache.get_or_load(
+            input_text, lambda: self._load(tier, input_text), namespace=tier)
+
+    async def _load(self, tier, input_text):
+        # A near-duplicate of an answered sentence, e.g. with an extra particle, reuses its emoji
+        if self.near_duplicates is not None:
+            ret = self.near_duplicates.lookup(input_text)
+            if ret is not None:
+                logger.debug("Near-duplicate hit: %s", input_text)
+                return ret
+
+        ret = await self._query_backend(tier, input_text)
+        if self.near_duplicates is not None and ret:
+            self.near_duplicates.insert(input_text, ret)
+        return ret
+
+    async def _query_backend(self, tier, input_text):
+        logger.debug("Query (%s): %s", tier, input_text)
+        self.tier_stats[f"backend_{tier}"] += 1
+        with tracer.span("query", tier=tier, input_length=len(input_text)):
+            ret = await self.backends[tier].complete(input_text)
 
         ret = post_process_output(ret)
-        logger.info(f"Input: `{input_text}` Output: `{ret}`")
+        logger.info("Input: `%s` Output: `%s` Tier: %s", input_text, ret, tier, extra=SAMPLED)
         return ret
 
+    def cache_clear(self):
+        super().cache_clear()
+        if self.near_duplicates is not None:
+            self.near_duplicates.clear()
+
     async def close(self):
-        await self.aio_session.close()
+        for backend in self.backends.values():
+            await backend.close()
 
 
-def preprocess_input_text(input_text: str):
-    input_text = re.sub(r"https?://\S+|www\.\S+", "", input_text)
+def preprocess_input_text(input_text: str, min_clause_length: int = 0, max_clause_length: int = DEFAULT_MAX_CLAUSE_LENGTH):
+    """Splits text into sentences and the delimiters after them; CJK fragments shorter than `min_clause_length` are merged into clauses."""
+    input_text = URL_PATTERN.sub("", input_text)
     language_label = language_model.predict(
         [input_text.replace("\n", "")])[0][0][0]
     if language_label in ['__label__zh', '__label__ja', '__label__ko']:
-        input_text = input_text.strip(" \n")
-        parts = re.split(r'([ ，,。.？?！!;\n\s]+)', input_text)
-        sentence_list = parts[::2]
-        delimiter_list = parts[1::2]
-
-        while len(sentence_list) > 0 and sentence_list[-1] == '':
-            sentence_list.pop()
-            if len(delimiter_list) > len(sentence_list):
-                delimiter_list.pop()
-        delimiter_list += [''] * (len(sentence_list) - len(delimiter_list))
+        sentence_list, delimiter_list = split_cjk(input_text)
+        if min_clause_length:
+            sentence_list, delimiter_list = coalesce_fragments(
+                sentence_list, delimiter_list, min_clause_length, max_clause_length)
         return sentence_list, delimiter_list
     else:
         sentences = nltk.tokenize.sent_tokenize(input_text, language='english')
@@ -167,7 +376,7 @@ def post_process_output(output_emoji: str):
     ret = ''.join(char for char in output_emoji if emoji.is_emoji(char))
 
     if output_emoji != ret:
-        logger.warning(f"Model output contains non-emoji: `{output_emoji}` Post Processed: `{ret}`")
+        logger.warning("Model output contains non-emoji: `%s` Post Processed: `%s`", output_emoji, ret, extra=SAMPLED)
 
     return ret
 
@@ -0,0 +1,137 @@
+'''
+This module moves feedback partitions past the retention window into zstd-compressed Parquet files
+for offline training, then drops them from the database.
+
+Requires pyarrow. Run it once by hand with:
+    python feedback_compaction.py --retention-days 90 --export-dir ../data/feedback_export
+'''
+
+import asyncio
+import logging
+import os
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+logger = logging.getLogger()
+
+READ_CHUNK_SIZE = 5000
+
+
+def _open_parquet_writer(path: str):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("input", pa.string()),
+        ("output", pa.string()),
+        ("user_id", pa.string()),
+        ("create_time", pa.timestamp("us")),
+        ("preference", pa.int8()),
+    ])
+    return pq.ParquetWriter(path, schema, compression="zstd"), schema
+
+
+def _write_parquet_chunk(writer, schema, rows: list[tuple]):
+    import pyarrow as pa
+
+    columns = [list(column) for column in zip(*rows)]
+    # SQLite hands back timestamps as ISO strings
+    columns[4] = [datetime.fromisoformat(t) if isinstance(t, str) else t
+                  for t in columns[4]]
+    table = pa.Table.from_arrays(
+        [pa.array(column, type=field.type)
+         for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+    writer.write_table(table)
+
+
+async def export_feedback_partition(db, name: str, path: str) -> int:
+    """Streams a partition into a Parquet file in chunks, so the database is never locked for long."""
+    tmp_path = path + ".tmp"
+    writer, schema = await asyncio.to_thread(_open_parquet_writer, tmp_path)
+    row_count = 0
+    last_id = 0
+    try:
+        try:
+            while True:
+                rows = await db.read_feedback_partition(name, after_id=last_id, limit=READ_CHUNK_SIZE)
+                if not rows:
+                    break
+                await asyncio.to_thread(_write_parquet_chunk, writer, schema, rows)
+                row_count += len(rows)
+                last_id = rows[-1][0]
+        finally:
+            await asyncio.to_thread(writer.close)
+    except BaseException:
+        # Cancelled by shutdown or failed: leave no partial export behind; the partition is kept
+        os.remove(tmp_path)
+        raise
+
+    os.replace(tmp_path, path)
+    return row_count
+
+
+async def compact_feedback(db, retention_days: int, export_dir: str, now: datetime = None) -> list[str]:
+    """Exports and drops every feedback partition entirely older than the retention window."""
+    now = now or datetime.now()
+    cutoff = now - timedelta(days=retention_days)
+    os.makedirs(export_dir, exist_ok=True)
+
+    compacted = []
+    for name, upper_bound in await db.list_feedback_partitions():
+        if upper_bound > cutoff:
+            continue
+
+        # The legacy table has no fixed month, so name its export after the newest row it held
+        path = os.path.join(
+            export_dir, f"{name}_until_{upper_bound:%Y%m%d}.parquet")
+        row_count = await export_feedback_partition(db, name, path)
+        await db.drop_feedback_partition(name)
+        logger.info(f"Compacted feedback partition {name}: {row_count} rows -> {path}")
+        compacted.append(name)
+    return compacted
+
+
+async def database_maintenance_loop(db, retention_days: int, export_dir: str, interval: float = 3600):
+    """Keeps upcoming partitions created, prunes stale active-user rows and, if `retention_days` is set, compacts cold partitions."""
+    while True:
+        try:
+            now = datetime.now()
+            await db.ensure_feedback_partitions(now)
+            await db.prune_daily_active_users(before=(now - timedelta(days=2)).date())
+            if retention_days is not None:
+                await compact_feedback(db, retention_days, export_dir)
+        except Exception:
+            logger.exception("Feedback maintenance failed")
+        await asyncio.sleep(interval)
+
+
+async def main(args):
+    logging.basicConfig(level=logging.INFO)
+    if args.dsn is None:
+        from db_sqlite import Database
+        dsn = "../data/emojilm.db"
+    else:
+        from db_pg import Database
+        dsn = args.dsn
+
+    db = await Database.create_and_connect(dsn=dsn)
+    try:
+        compacted = await compact_feedback(db, args.retention_days, args.export_dir)
+        print(f"Compacted partitions: {compacted}")
+    finally:
+        await db.close()
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--dsn', default=os.getenv('POSTGRES_DSN', None))
+    parser.add_argument('--retention-days', type=int, required=True)
+    parser.add_argument('--export-dir', default="../data/feedback_export")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,52 @@
+'''
+This module builds the aiohttp sessions used to reach the EmojiLm backend.
+Endpoints can be plain http(s) URLs or `unix:///path/to/server.sock` for a co-located llama.cpp server.
+'''
+
+import logging
+
+import aiohttp
+
+logger = logging.getLogger()
+
+UNIX_SCHEME = "unix://"
+UNIX_BASE_URL = "http://localhost/"
+
+
+def create_client_session(
+    url: str,
+    pool_size: int,
+    keepalive_timeout: float = 60,
+    connect_timeout: float = 5,
+    read_timeout: float = 30,
+    total_timeout: float = None,
+) -> tuple[aiohttp.ClientSession, str]:
+    """Creates a session with a connection pool sized for `pool_size` concurrent requests.
+
+    Returns the session and the http base URL requests should be built against.
+    """
+    timeout = aiohttp.ClientTimeout(
+        total=total_timeout,
+        sock_connect=connect_timeout,
+        sock_read=read_timeout,
+    )
+
+    if url.startswith(UNIX_SCHEME):
+        socket_path = url[len(UNIX_SCHEME):]
+        connector = aiohttp.UnixConnector(
+            path=socket_path,
+            limit=pool_size,
+            keepalive_timeout=keepalive_timeout,
+        )
+        base_url = UNIX_BASE_URL
+        logger.info(f"Using Unix socket transport: {socket_path}")
+    else:
+        connector = aiohttp.TCPConnector(
+            limit=pool_size,
+            keepalive_timeout=keepalive_timeout,
+            ttl_dns_cache=300,
+        )
+        base_url = url if url.endswith('/') else url + '/'
+
+    session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return session, base_url
@@ -0,0 +1,208 @@
+'''
+Continuous multi-sequence decoding of short prompts with the low-level llama.cpp API.
+
+Every prompt gets its own sequence id in one shared context. Each `step` is a single `llama_decode`
+call holding the prompt tokens of newly admitted prompts and the last sampled token of every running
+sequence, so prompts join and leave the batch between steps instead of waiting for a whole batch.
+Not thread safe: call it from one thread.
+'''
+
+import ctypes
+import logging
+
+logger = logging.getLogger()
+
+# llama.cpp's own defaults for the samplers the completion payload does not set
+DEFAULT_TOP_K = 40
+DEFAULT_MIN_P = 0.05
+PENALTY_LAST_N = 64
+
+
+class _Sequence:
+    __slots__ = ("seq_id", "request_id", "n_past", "next_token", "logits_index", "generated", "text")
+
+    def __init__(self, seq_id: int):
+        self.seq_id = seq_id
+        self.request_id = None
+
+
+class LlamaBatchDecoder:
+    """Decodes up to `n_seq_max` prompts at once, each in its own sequence of at most `n_ctx_per_seq` tokens."""
+
+    def __init__(self, model_path: str, n_seq_max: int = 32, n_ctx_per_seq: int = 128, n_threads: int = None,
+                 max_tokens: int = 5, temperature: float = 0.3, top_p: float = 0.7, frequency_penalty: float = 1.1,
+                 stop: tuple[str, ...] = ("\n", "\t", " ", "."), seed: int = 0xFFFFFFFF):
+        import llama_cpp
+
+        # Like Llama(verbose=False): only llama.cpp errors reach stderr
+        logging.getLogger("llama-cpp-python").setLevel(logging.ERROR)
+
+        self.lib = llama_cpp
+        self.max_tokens = max_tokens
+        self.stop = stop
+        self.n_ctx_per_seq = n_ctx_per_seq
+        # Prompt tokens kept per sequence; the rest of its cells hold the generated tokens
+        self.max_prompt_tokens = n_ctx_per_seq - max_tokens
+
+        llama_cpp.llama_backend_init()
+        self.model = llama_cpp.llama_model_load_from_file(
+            model_path.encode(), llama_cpp.llama_model_default_params())
+        if not self.model:
+            raise ValueError(f"Failed to load GGUF model: {model_path}")
+        self.vocab = llama_cpp.llama_model_get_vocab(self.model)
+
+        n_ctx = n_seq_max * n_ctx_per_seq
+        ctx_params = llama_cpp.llama_context_default_params()
+        ctx_params.n_ctx = n_ctx
+        # A step never holds more than one context's worth of tokens, so it is always one decode call
+        ctx_params.n_batch = n_ctx
+        ctx_params.n_ubatch = min(n_ctx, 512)
+        ctx_params.n_seq_max = n_seq_max
+        if n_threads is not None:
+            ctx_params.n_threads = n_threads
+            ctx_params.n_threads_batch = n_threads
+        self.ctx = llama_cpp.llama_init_from_model(self.model, ctx_params)
+        if not self.ctx:
+            llama_cpp.llama_model_free(self.model)
+            raise ValueError(f"Failed to create a llama.cpp context for {model_path}")
+        self.memory = llama_cpp.llama_get_memory(self.ctx)
+        self.batch = llama_cpp.llama_batch_init(n_ctx, 0, 1)
+
+        n_vocab = llama_cpp.llama_vocab_n_tokens(self.vocab)
+        self.samplers = []
+        for seq_id in range(n_seq_max):
+            sampler = llama_cpp.llama_sampler_chain_init(llama_cpp.llama_sampler_chain_default_params())
+            # Same order as llama.cpp's default sampler chain
+            for stage in (
+                llama_cpp.llama_sampler_init_penalties(n_vocab, PENALTY_LAST_N, 1.0, frequency_penalty, 0.0),
+                llama_cpp.llama_sampler_init_top_k(DEFAULT_TOP_K),
+                llama_cpp.llama_sampler_init_top_p(top_p, 1),
+                llama_cpp.llama_sampler_init_min_p(DEFAULT_MIN_P, 1),
+                llama_cpp.llama_sampler_init_temp(temperature),
+                llama_cpp.llama_sampler_init_dist(seed),
+            ):
+                llama_cpp.llama_sampler_chain_add(sampler, stage)
+            self.samplers.append(sampler)
+
+        self.free_sequences = [_Sequence(seq_id) for seq_id in reversed(range(n_seq_max))]
+        self.running: list[_Sequence] = []
+        self.token_buffer = (llama_cpp.llama_token * n_ctx_per_seq)()
+        self.piece_buffer = ctypes.create_string_buffer(64)
+        logger.info(f"Loaded GGUF model in-process: {model_path} ({n_seq_max} sequences x {n_ctx_per_seq} tokens)")
+
+    @property
+    def free_slots(self) -> int:
+        return len(self.free_sequences)
+
+    @property
+    def idle(self) -> bool:
+        return not self.running
+
+    def tokenize(self, prompt: str) -> list[int]:
+        encoded = prompt.encode()
+        n_tokens = self.lib.llama_tokenize(
+            self.vocab, encoded, len(encoded), self.token_buffer, self.n_ctx_per_seq, True, False)
+        if n_tokens < 0:
+            # Longer than a sequence; tokenize in full and keep the end, next to where the emoji goes
+            buffer = (self.lib.llama_token * -n_tokens)()
+            n_tokens = self.lib.llama_tokenize(self.vocab, encoded, len(encoded), buffer, -n_tokens, True, False)
+            return list(buffer[:n_tokens])[-self.max_prompt_tokens:]
+        return list(self.token_buffer[:n_tokens])[-self.max_prompt_tokens:]
+
+    def _add(self, token: int, pos: int, seq_id: int, logits: bool):
+        batch = self.batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.n_seq_id[i] = 1
+        batch.seq_id[i][0] = seq_id
+        batch.logits[i] = logits
+        batch.n_tokens = i + 1
+
+    def step(self, prompts: list[tuple[int, str]]) -> list[tuple[int, str]]:
+        """Admits `(request_id, prompt)` pairs, decodes one token for every sequence, and returns the finished ones.
+
+        At most `free_slots` prompts may be admitted per step.
+        """
+        if len(prompts) > len(self.free_sequences):
+            raise ValueError(f"{len(prompts)} prompts for {len(self.free_sequences)} free sequences")
+
+        self.batch.n_tokens = 0
+        for sequence in self.running:
+            sequence.logits_index = self.batch.n_tokens
+            self._add(sequence.next_token, sequence.n_past, sequence.seq_id, True)
+            sequence.n_past += 1
+
+        for request_id, prompt in prompts:
+            tokens = self.tokenize(prompt)
+            sequence = self.free_sequences.pop()
+            sequence.request_id = request_id
+            sequence.generated = 0
+            sequence.text = b""
+            for pos, token in enumerate(tokens):
+                self._add(token, pos, sequence.seq_id, pos == len(tokens) - 1)
+            sequence.logits_index = self.batch.n_tokens - 1
+            sequence.n_past = len(tokens)
+            self.running.append(sequence)
+
+        if self.batch.n_tokens == 0:
+            return []
+        ret = self.lib.llama_decode(self.ctx, self.batch)
+        if ret != 0:
+            self.reset()
+            raise RuntimeError(f"llama_decode failed with status {ret}")
+
+        finished = []
+        still_running = []
+        for sequence in self.running:
+            text = self._sample(sequence)
+            if text is None:
+                still_running.append(sequence)
+            else:
+                finished.append((sequence.request_id, text))
+                self._release(sequence)
+        self.running = still_running
+        return finished
+
+    def _sample(self, sequence: _Sequence) -> str:
+        """Samples the sequence's next token; returns its completion once it is done, else None."""
+        token = self.lib.llama_sampler_sample(self.samplers[sequence.seq_id], self.ctx, sequence.logits_index)
+        sequence.generated += 1
+        if self.lib.llama_vocab_is_eog(self.vocab, token):
+            return sequence.text.decode(errors="ignore")
+
+        n_bytes = self.lib.llama_token_to_piece(
+            self.vocab, token, self.piece_buffer, len(self.piece_buffer), 0, False)
+        sequence.text += self.piece_buffer.raw[:max(n_bytes, 0)]
+        # A multi-byte character may still be incomplete, which errors="ignore" drops until it is
+        text = sequence.text.decode(errors="ignore")
+        stop_at = min((i for i in (text.find(s) for s in self.stop) if i >= 0), default=-1)
+        if stop_at >= 0:
+            return text[:stop_at]
+        if sequence.generated >= self.max_tokens:
+            return text
+        sequence.next_token = token
+        return None
+
+    def _release(self, sequence: _Sequence):
+        self.lib.llama_memory_seq_rm(self.memory, sequence.seq_id, -1, -1)
+        self.lib.llama_sampler_reset(self.samplers[sequence.seq_id])
+        sequence.request_id = None
+        self.free_sequences.append(sequence)
+
+    def reset(self) -> list[int]:
+        """Drops every running sequence and returns their request ids."""
+        request_ids = [sequence.request_id for sequence in self.running]
+        for sequence in self.running:
+            self._release(sequence)
+        self.running = []
+        self.lib.llama_memory_clear(self.memory, True)
+        return request_ids
+
+    def close(self):
+        for sampler in self.samplers:
+            self.lib.llama_sampler_free(sampler)
+        self.samplers = []
+        self.lib.llama_batch_free(self.batch)
+        self.lib.llama_free(self.ctx)
+        self.lib.llama_model_free(self.model)
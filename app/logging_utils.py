@@ -0,0 +1,58 @@
+'''
+Logging helpers that keep file I/O and message formatting off the event loop.
+
+Records go through a queue to a background listener thread, which formats them and writes
+to a size-rotated log whose rotated files are gzip-compressed.
+'''
+
+import gzip
+import logging
+import logging.handlers
+import os
+import random
+import shutil
+
+# Pass as `extra` on high-volume hot-path lines, so only a sample of them is kept
+SAMPLED = {"sampled": True}
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a `sample_rate` fraction of the records logged with `extra=SAMPLED`, and every other record."""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sampled", False):
+            return random.random() < self.sample_rate
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records unformatted; `%` formatting happens in the listener thread.
+
+    The stock QueueHandler formats every record in the caller so it can be pickled,
+    which is not needed for an in-process queue.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def gzip_namer(name: str) -> str:
+    return name + ".gz"
+
+
+def gzip_rotator(source: str, dest: str):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def create_rotating_file_handler(log_path: str, max_bytes: int, backup_count: int) -> logging.Handler:
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf8')
+    file_handler.namer = gzip_namer
+    file_handler.rotator = gzip_rotator
+    return file_handler
@@ -0,0 +1,117 @@
+'''
+Event-loop health tools: a lag monitor that records scheduling delay and dumps the stack of
+whatever is blocking the loop, and a sampling profiler that produces folded stacks
+(the input format of flamegraph.pl and speedscope).
+'''
+
+import asyncio
+import bisect
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+logger = logging.getLogger()
+
+LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+def _frame_stack(frame) -> list[str]:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class LoopLagMonitor:
+    """Measures how late the loop runs a timer scheduled every `interval` seconds.
+
+    A watchdog thread checks the loop's heartbeat, so while the loop is still blocked
+    it can log the stack of the code blocking it.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self.histogram = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.max_lag_ms = 0.0
+        self.stall_count = 0
+
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.task = None
+        self.watchdog = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.task = asyncio.create_task(self._measure())
+        self.watchdog = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        self.stopped.set()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def _measure(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.heartbeat = now
+            lag_ms = max(0.0, (now - expected) * 1000)
+            self.histogram[bisect.bisect_left(LAG_BUCKETS_MS, lag_ms)] += 1
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+
+    def _watch(self):
+        reported_heartbeat = None
+        while not self.stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.threshold or heartbeat == reported_heartbeat:
+                continue
+
+            # Report each stall once, while it is still happening
+            reported_heartbeat = heartbeat
+            self.stall_count += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<unavailable>"
+            logger.warning("Event loop blocked for %.0f ms, stack of the blocking code:\n%s",
+                           blocked_for * 1000, stack)
+
+    def stats(self) -> dict:
+        buckets = {f"le_{bound}ms": count for bound, count in zip(LAG_BUCKETS_MS, self.histogram)}
+        buckets["gt_5000ms"] = self.histogram[-1]
+        return {
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "max_lag_ms": round(self.max_lag_ms, 1),
+            "stall_count": self.stall_count,
+            "histogram": buckets,
+        }
+
+
+def sample_stacks(thread_id: int, duration: float, interval: float = 0.005) -> Counter:
+    """Samples one thread's stack every `interval` seconds; blocks the calling thread for `duration`."""
+    samples = Counter()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples[";".join(_frame_stack(frame))] += 1
+        time.sleep(interval)
+    return samples
+
+
+def format_folded(samples: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
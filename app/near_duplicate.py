@@ -0,0 +1,166 @@
+'''
+MinHash/LSH index over the characters and character bigrams of answered sentences, so trivial variants
+of a sentence ("哈哈哈哈" vs "哈哈哈", "ＯＫ啦" vs "ok", "好喔" vs "好喔喔") reuse its emoji instead of
+costing another model call.
+
+Sentences are canonicalized (NFKC, casefolded, punctuation and whitespace removed, character runs
+capped at two, trailing particles dropped) before shingling. Unigrams keep short sentences, where one
+extra character changes most bigrams, above the threshold. Sentences with a different number of
+negations never match, however similar. The index is in memory only, so Python's salted `hash` is fine.
+'''
+
+import random
+import re
+import unicodedata
+from array import array
+from collections import Counter, OrderedDict, defaultdict
+
+MASK_64 = (1 << 64) - 1
+PERMUTATION_SEED = 1
+
+# Sentences longer than this skip the index; signatures cost time on the event loop, and long
+# sentences are rarely trivial variants of each other
+DEFAULT_MAX_SENTENCE_LENGTH = 32
+
+# Punctuation, symbols (including emoji) and whitespace carry no meaning for matching
+NON_WORD_PATTERN = re.compile(r'[\W_]+')
+REPEAT_PATTERN = re.compile(r'(.)\1{2,}')
+# Sentence-final particles of Mandarin chat, dropped from the end of a sentence
+TRAILING_PARTICLE_PATTERN = re.compile(r'(?<=.)[啦喔哦噢啊阿呀耶欸誒嘛吧呢囉咧唷齁捏餒ㄟ]+$')
+# Negations, counted on the casefolded text; words like 非常 count too, but the same on both sides
+NEGATION_PATTERN = re.compile(
+    r"[不沒没別别無无非未勿甭莫]|n[’']t\b"
+    r"|\b(?:no|not|never|nothing|nobody|none|cannot|dont|doesnt|didnt|isnt|cant|wont)\b")
+
+
+def canonicalize(text: str) -> str:
+    text = NON_WORD_PATTERN.sub('', unicodedata.normalize('NFKC', text).casefold())
+    text = REPEAT_PATTERN.sub(r'\1\1', text)
+    return TRAILING_PARTICLE_PATTERN.sub('', text)
+
+
+def count_negations(text: str) -> int:
+    return len(NEGATION_PATTERN.findall(unicodedata.normalize('NFKC', text).casefold()))
+
+
+def shingles(text: str) -> set[str]:
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class NearDuplicateIndex:
+    """Finds a previously answered sentence whose estimated Jaccard similarity is at least `threshold`.
+
+    Signatures of `bands * rows` MinHashes are split into bands; sentences sharing any band
+    bucket are candidates, and the most similar candidate wins. The oldest entries are evicted
+    past `max_entries`, and a matched entry counts as fresh again.
+    """
+
+    def __init__(self, threshold: float = 0.75, max_entries: int = 20000, bands: int = 8, rows: int = 4,
+                 max_length: int = DEFAULT_MAX_SENTENCE_LENGTH):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = rows
+        self.max_length = max_length
+
+        # Multiplying by a random odd number mod 2^64 permutes the hashes; it is half the cost of (a*h + b) mod p
+        rng = random.Random(PERMUTATION_SEED)
+        self.multipliers = [rng.getrandbits(64) | 1 for _ in range(bands * rows)]
+        # entry id -> (signature, negation count, emoji), oldest first
+        self.entries: OrderedDict[int, tuple[array, int, str]] = OrderedDict()
+        # one bucket table per band: band hash -> entry ids
+        self.buckets: list[defaultdict[int, set[int]]] = [defaultdict(set) for _ in range(bands)]
+        self.next_id = 0
+        self.counters = Counter()
+
+    def signature(self, text: str) -> array:
+        """MinHashes of the sentence's shingles; None if it is empty or too long to index."""
+        if len(text) > self.max_length:
+            return None
+        canonical = canonicalize(text)
+        if not canonical:
+            return None
+        hashes = [hash(shingle) & MASK_64 for shingle in shingles(canonical)]
+        return array('Q', (min((a * h) & MASK_64 for h in hashes) for a in self.multipliers))
+
+    def _band_keys(self, signature: array) -> list[int]:
+        rows = self.rows
+        return [hash(tuple(signature[band * rows:(band + 1) * rows])) for band in range(self.bands)]
+
+    def _best_match(self, signature: array, negations: int, band_keys: list[int]) -> tuple[int, float]:
+        candidates = set()
+        for buckets, band_key in zip(self.buckets, band_keys):
+            bucket = buckets.get(band_key)
+            if bucket:
+                candidates |= bucket
+
+        best_id, best_similarity = None, 0.0
+        for entry_id in candidates:
+            entry_signature, entry_negations, _ = self.entries[entry_id]
+            # "好喔" and "不好喔" differ in one character but mean the opposite
+            if entry_negations != negations:
+                continue
+            similarity = sum(x == y for x, y in zip(signature, entry_signature)) / len(signature)
+            if similarity > best_similarity:
+                best_id, best_similarity = entry_id, similarity
+        return best_id, best_similarity
+
+    def lookup(self, text: str) -> str:
+        """Returns the emoji of the most similar answered sentence above the threshold, or None."""
+        self.counters["lookups"] += 1
+        signature = self.signature(text)
+        if signature is None:
+            return None
+        entry_id, similarity = self._best_match(signature, count_negations(text), self._band_keys(signature))
+        if entry_id is None or similarity < self.threshold:
+            return None
+        self.entries.move_to_end(entry_id)
+        self.counters["hits"] += 1
+        return self.entries[entry_id][2]
+
+    def insert(self, text: str, value: str):
+        signature = self.signature(text)
+        if signature is None:
+            return
+        negations = count_negations(text)
+        band_keys = self._band_keys(signature)
+        entry_id, similarity = self._best_match(signature, negations, band_keys)
+        if entry_id is not None and similarity == 1.0:
+            # Same canonical sentence; keep one entry with the newest answer
+            self.entries[entry_id] = (signature, negations, value)
+            self.entries.move_to_end(entry_id)
+            return
+
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (signature, negations, value)
+        for buckets, band_key in zip(self.buckets, band_keys):
+            buckets[band_key].add(entry_id)
+        self.counters["inserts"] += 1
+
+        while len(self.entries) > self.max_entries:
+            self._evict()
+
+    def _evict(self):
+        entry_id, (signature, _, _) = self.entries.popitem(last=False)
+        for buckets, band_key in zip(self.buckets, self._band_keys(signature)):
+            bucket = buckets[band_key]
+            bucket.discard(entry_id)
+            if not bucket:
+                del buckets[band_key]
+        self.counters["evictions"] += 1
+
+    def clear(self):
+        self.entries.clear()
+        for buckets in self.buckets:
+            buckets.clear()
+
+    def stats(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "entries": len(self.entries),
+            "lookups": self.counters["lookups"],
+            "backend_calls_saved": self.counters["hits"],
+            "inserts": self.counters["inserts"],
+            "evictions": self.counters["evictions"],
+        }
@@ -0,0 +1,63 @@
+'''
+Splits CJK text into the units emojis are generated for, and optionally merges short fragments
+into clauses so a paragraph costs fewer model calls.
+
+Every unit is followed by its delimiter, so `"".join(unit + emoji + delimiter)` rebuilds the text.
+'''
+
+import re
+
+URL_PATTERN = re.compile(r"https?://\S+|www\.\S+")
+CJK_DELIMITER_PATTERN = re.compile(r'([ ，,。.？?！!;\n\s]+)')
+# Han, kana and Hangul; text without any is split into sentences, not fragments
+CJK_CHARACTER_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+# Delimiters that end a sentence; fragments are never merged across them
+SENTENCE_END_PATTERN = re.compile(r'[。.？?！!\n]')
+
+DEFAULT_MAX_CLAUSE_LENGTH = 20
+
+
+def split_cjk(input_text: str) -> tuple[list[str], list[str]]:
+    input_text = input_text.strip(" \n")
+    parts = CJK_DELIMITER_PATTERN.split(input_text)
+    sentence_list = parts[::2]
+    delimiter_list = parts[1::2]
+
+    while len(sentence_list) > 0 and sentence_list[-1] == '':
+        sentence_list.pop()
+        if len(delimiter_list) > len(sentence_list):
+            delimiter_list.pop()
+    delimiter_list += [''] * (len(sentence_list) - len(delimiter_list))
+    return sentence_list, delimiter_list
+
+
+def _can_merge(clause: str, delimiter: str, fragment: str, min_length: int, max_length: int) -> bool:
+    return (len(clause) < min_length
+            and not SENTENCE_END_PATTERN.search(delimiter)
+            and len(clause) + len(delimiter) + len(fragment) <= max_length)
+
+
+def coalesce_fragments(sentence_list: list[str], delimiter_list: list[str], min_length: int,
+                       max_length: int = DEFAULT_MAX_CLAUSE_LENGTH) -> tuple[list[str], list[str]]:
+    """Merges fragments shorter than `min_length` with their neighbours into clauses of at most `max_length` characters.
+
+    Merges only cross spaces and commas. A clause keeps the delimiters inside it and takes
+    the delimiter of its last fragment, so the output rebuilds the same way.
+    """
+    clauses = []
+    clause_delimiters = []
+    for sentence, delimiter in zip(sentence_list, delimiter_list):
+        if clauses and _can_merge(clauses[-1], clause_delimiters[-1], sentence, min_length, max_length):
+            clauses[-1] += clause_delimiters[-1] + sentence
+            clause_delimiters[-1] = delimiter
+        else:
+            clauses.append(sentence)
+            clause_delimiters.append(delimiter)
+
+    # A short fragment at the end joins the clause before it instead of standing alone
+    if (len(clauses) >= 2 and len(clauses[-1]) < min_length
+            and not SENTENCE_END_PATTERN.search(clause_delimiters[-2])
+            and len(clauses[-2]) + len(clause_delimiters[-2]) + len(clauses[-1]) <= max_length):
+        tail = clauses.pop()
+        clauses[-1] += clause_delimiters.pop(-2) + tail
+    return clauses, clause_delimiters
@@ -0,0 +1,240 @@
+'''
+Async sentence -> emoji cache bounded by bytes, with W-TinyLFU admission.
+
+New sentences enter a small LRU window. When the window overflows, its oldest sentence only
+replaces the main area's eviction victim if a count-min sketch says it has been seen more
+often, so a long one-off paste cannot flush the short phrases that are asked every day.
+Keys are 64-bit hashes of the normalized sentence, and concurrent loads of one key are
+coalesced into a single backend call.
+'''
+
+import asyncio
+import hashlib
+import re
+import unicodedata
+from collections import Counter, OrderedDict
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+DEFAULT_CACHE_BYTES = 16 * 1024 * 1024
+
+# Rough per-entry cost of the hashed key, the OrderedDict node and the value tuple, in bytes
+ENTRY_OVERHEAD = 160
+
+# bytes.translate table that halves every counter of the sketch
+HALVE_TABLE = bytes(i >> 1 for i in range(256))
+SKETCH_DEPTH = 4
+SKETCH_MAX_COUNT = 15
+SKETCH_SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+MASK_64 = (1 << 64) - 1
+
+
+def normalize_sentence(text: str) -> str:
+    return WHITESPACE_PATTERN.sub(' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+def sentence_key(text: str, namespace: str = "") -> int:
+    digest = hashlib.blake2b(f"{namespace}\0{normalize_sentence(text)}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class FrequencySketch:
+    """Count-min sketch of 4-bit counters, halved every `10 * width` increments so old popularity fades."""
+
+    def __init__(self, expected_entries: int):
+        width = 64
+        while width < expected_entries:
+            width <<= 1
+        self.mask = width - 1
+        self.rows = [bytearray(width) for _ in range(SKETCH_DEPTH)]
+        self.sample_size = 10 * width
+        self.additions = 0
+
+    def _indexes(self, key: int):
+        for seed in SKETCH_SEEDS:
+            yield ((key * seed) & MASK_64) >> 40 & self.mask
+
+    def increment(self, key: int):
+        for row, index in zip(self.rows, self._indexes(key)):
+            if row[index] < SKETCH_MAX_COUNT:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.rows = [bytearray(row.translate(HALVE_TABLE)) for row in self.rows]
+            self.additions //= 2
+
+    def frequency(self, key: int) -> int:
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+
+class SentenceCache:
+    """Maps sentences to generated emojis within `max_bytes`.
+
+    1% of the capacity is an LRU window for new entries; the rest is a segmented LRU
+    (probation and protected) guarded by the TinyLFU admission filter. `namespace`
+    separates values of the same sentence from different models.
+    """
+
+    WINDOW_FRACTION = 0.01
+    PROTECTED_FRACTION = 0.8
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.window_max = max(int(max_bytes * self.WINDOW_FRACTION), ENTRY_OVERHEAD * 4)
+        self.main_max = max(max_bytes - self.window_max, 0)
+        self.protected_max = int(self.main_max * self.PROTECTED_FRACTION)
+
+        # key -> (value, size), each in LRU order
+        self.window: OrderedDict[int, tuple[str, int]] = OrderedDict()
+        self.probation: OrderedDict[int, tuple[str, int]] = OrderedDict()
+        self.protected: OrderedDict[int, tuple[str, int]] = OrderedDict()
+        self.window_bytes = 0
+        self.probation_bytes = 0
+        self.protected_bytes = 0
+
+        self.sketch = FrequencySketch(max_bytes // ENTRY_OVERHEAD)
+        self.in_flight: dict[int, asyncio.Future] = {}
+        self.counters = Counter()
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def get(self, text: str, namespace: str = "", count_miss: bool = True) -> str:
+        """Returns the cached value or None.
+
+        With `count_miss=False` a miss is only a peek: it counts neither as a miss nor toward the sentence's
+        frequency, since the lookup that follows it decides the result and is counted instead.
+        """
+        return self._get(sentence_key(text, namespace), count_miss)
+
+    def put(self, text: str, value: str, namespace: str = ""):
+        self._put(sentence_key(text, namespace), value)
+
+    async def get_or_load(self, text: str, load, namespace: str = "") -> str:
+        """Returns the cached value, or awaits `load()` once for all concurrent callers and caches it."""
+        key = sentence_key(text, namespace)
+        value = self._get(key, count_miss=True)
+        if value is not None:
+            return value
+
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.counters["coalesced"] += 1
+        else:
+            future = asyncio.ensure_future(load())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda f: self._on_loaded(key, f))
+        # A cancelled caller must not cancel the load other callers are waiting for
+        return await asyncio.shield(future)
+
+    def _on_loaded(self, key: int, future: asyncio.Future):
+        del self.in_flight[key]
+        if not future.cancelled() and future.exception() is None:
+            self._put(key, future.result())
+
+    def invalidate(self, text: str, namespace: str = ""):
+        key = sentence_key(text, namespace)
+        for segment in (self.window, self.probation, self.protected):
+            entry = segment.pop(key, None)
+            if entry is not None:
+                self._add_bytes(segment, -entry[1])
+
+    def clear(self):
+        self.window.clear()
+        self.probation.clear()
+        self.protected.clear()
+        self.window_bytes = self.probation_bytes = self.protected_bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            "hits": self.counters["hits"],
+            "misses": self.counters["misses"],
+            "hit_ratio": self.counters["hits"] / lookups if lookups else None,
+            "coalesced": self.counters["coalesced"],
+            "evictions": self.counters["evictions"],
+            "rejections": self.counters["rejections"],
+            "entries": len(self),
+            "bytes": self.window_bytes + self.probation_bytes + self.protected_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _get(self, key: int, count_miss: bool) -> str:
+        if key in self.window:
+            self.window.move_to_end(key)
+            entry = self.window[key]
+        elif key in self.protected:
+            self.protected.move_to_end(key)
+            entry = self.protected[key]
+        elif key in self.probation:
+            # A second hit promotes an entry out of probation
+            entry = self.probation.pop(key)
+            self.probation_bytes -= entry[1]
+            self.protected[key] = entry
+            self.protected_bytes += entry[1]
+            while self.protected_bytes > self.protected_max:
+                demoted_key, demoted = self.protected.popitem(last=False)
+                self.protected_bytes -= demoted[1]
+                self.probation[demoted_key] = demoted
+                self.probation_bytes += demoted[1]
+        else:
+            if count_miss:
+                self.sketch.increment(key)
+                self.counters["misses"] += 1
+            return None
+        self.sketch.increment(key)
+        self.counters["hits"] += 1
+        return entry[0]
+
+    def _put(self, key: int, value: str):
+        size = len(value.encode()) + ENTRY_OVERHEAD
+        for segment in (self.window, self.probation, self.protected):
+            old = segment.get(key)
+            if old is not None:
+                segment[key] = (value, size)
+                self._add_bytes(segment, size - old[1])
+                return
+
+        self.window[key] = (value, size)
+        self.window_bytes += size
+        while self.window_bytes > self.window_max:
+            candidate_key, candidate = self.window.popitem(last=False)
+            self.window_bytes -= candidate[1]
+            self._admit(candidate_key, candidate)
+
+    def _admit(self, key: int, entry: tuple[str, int]):
+        """Moves an entry evicted from the window into probation, if it beats the main area's victims."""
+        size = entry[1]
+        if size > self.main_max:
+            self.counters["rejections"] += 1
+            return
+
+        # Pick victims from the LRU end of probation, then protected, without evicting yet
+        candidate_frequency = self.sketch.frequency(key)
+        overflow = self.probation_bytes + self.protected_bytes + size - self.main_max
+        victims = []
+        for segment in (self.probation, self.protected):
+            for victim_key, victim in segment.items():
+                if overflow <= 0:
+                    break
+                if candidate_frequency <= self.sketch.frequency(victim_key):
+                    self.counters["rejections"] += 1
+                    return
+                victims.append((segment, victim_key))
+                overflow -= victim[1]
+
+        for segment, victim_key in victims:
+            victim = segment.pop(victim_key)
+            self._add_bytes(segment, -victim[1])
+            self.counters["evictions"] += 1
+
+        self.probation[key] = entry
+        self.probation_bytes += size
+
+    def _add_bytes(self, segment: OrderedDict, delta: int):
+        if segment is self.window:
+            self.window_bytes += delta
+        elif segment is self.probation:
+            self.probation_bytes += delta
+        else:
+            self.protected_bytes += delta
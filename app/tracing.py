@@ -0,0 +1,199 @@
+'''
+Minimal in-process tracing that exports finished traces as OTLP/JSON lines, one trace per line,
+so they can be loaded into any OpenTelemetry-compatible viewer after the fact.
+
+Spans nest through a ContextVar, so they follow asyncio tasks. Tracing is a no-op until
+`tracer.configure` is called.
+'''
+
+import functools
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import orjson
+from logging_utils import LazyQueueHandler, create_rotating_file_handler
+
+logger = logging.getLogger()
+
+SERVICE_NAME = "emojilm-linebot"
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_span_id", "name",
+                 "start_ns", "end_ns", "attributes", "status", "error")
+
+    def __init__(self, trace: 'Trace', name: str, parent_span_id: str, attributes: dict):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.status = STATUS_OK
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": self.status},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        if self.error:
+            span["status"]["message"] = self.error
+        return span
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "root_done", "exported")
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans: list[Span] = []
+        self.root_done = False
+        self.exported = False
+
+
+class _NoopSpan:
+    trace = None
+
+    def set_attribute(self, key: str, value):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+current_span: ContextVar[Span] = ContextVar("current_span", default=None)
+
+
+def _otlp_attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Tracer:
+    """Records spans and exports a trace when its root span ends.
+
+    A trace is exported with probability `sample_rate`, and always when its root
+    span took at least `slow_threshold` seconds.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.slow_threshold_ns = None
+        self.export_logger = None
+
+    def configure(self, export_path: str, sample_rate: float, slow_threshold: float = None,
+                  max_bytes: int = 50 * 1024 * 1024, backup_count: int = 5):
+        file_handler = create_rotating_file_handler(export_path, max_bytes, backup_count)
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+        export_queue = queue.SimpleQueue()
+        self.export_logger = logging.getLogger("emojilm.traces")
+        self.export_logger.propagate = False
+        self.export_logger.setLevel(logging.INFO)
+        self.export_logger.addHandler(LazyQueueHandler(export_queue))
+        self.listener = logging.handlers.QueueListener(export_queue, file_handler)
+        self.listener.start()
+
+        self.sample_rate = sample_rate
+        self.slow_threshold_ns = None if slow_threshold is None else int(slow_threshold * 1e9)
+        self.enabled = True
+        logger.info(f"Tracing to {export_path} (sample rate {sample_rate}, slow threshold {slow_threshold}s)")
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Starts a span under the current one, or a new trace if there is none."""
+        if not self.enabled:
+            yield NOOP_SPAN
+            return
+
+        parent = current_span.get()
+        if parent is None:
+            span = Span(Trace(), name, None, attributes)
+        else:
+            span = Span(parent.trace, name, parent.span_id, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = STATUS_ERROR
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            current_span.reset(token)
+            span.end_ns = time.time_ns()
+            self._finish(span, is_root=parent is None)
+
+    def _finish(self, span: Span, is_root: bool):
+        trace = span.trace
+        if trace.root_done:
+            # A span of a background task that outlived its trace's root follows the root's decision
+            if trace.exported:
+                self._export(trace, [span])
+            return
+
+        trace.spans.append(span)
+        if not is_root:
+            return
+
+        trace.root_done = True
+        duration_ns = span.end_ns - span.start_ns
+        is_slow = self.slow_threshold_ns is not None and duration_ns >= self.slow_threshold_ns
+        if is_slow or random.random() < self.sample_rate:
+            trace.exported = True
+            self._export(trace, trace.spans)
+        trace.spans = []
+
+    def _export(self, trace: Trace, spans: list[Span]):
+        self.export_logger.info(orjson.dumps({
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+                "scopeSpans": [{
+                    "scope": {"name": "emojilm"},
+                    "spans": [s.to_otlp() for s in spans],
+                }],
+            }],
+        }).decode())
+
+    def correlation_id(self) -> str:
+        """Trace id of the current span, for tying log lines to a trace."""
+        span = current_span.get()
+        return span.trace.trace_id if span is not None else None
+
+
+tracer = Tracer()
+
+
+def traced(name: str):
+    """Wraps every call of an async function in a span."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
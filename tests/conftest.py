@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# The app modules import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
+
+
+@pytest.fixture(scope="session")
+def gguf_path(tmp_path_factory):
+    """EMOJILM_TEST_GGUF if set, e.g. the real q8_0 weights, else a tiny random model written on the fly."""
+    path = os.getenv("EMOJILM_TEST_GGUF")
+    if path:
+        return path
+    pytest.importorskip("gguf")
+    from tiny_gguf import write_tiny_gguf
+
+    path = str(tmp_path_factory.mktemp("models") / "tiny.gguf")
+    write_tiny_gguf(path)
+    return path
+
+
+@pytest.fixture
+def pg_dsn():
+    """EMOJILM_TEST_PG_DSN, a Postgres the tests may create and drop schemas in."""
+    dsn = os.getenv("EMOJILM_TEST_PG_DSN")
+    if not dsn:
+        pytest.skip("EMOJILM_TEST_PG_DSN is not set")
+    pytest.importorskip("asyncpg")
+    return dsn
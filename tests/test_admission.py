@@ -0,0 +1,107 @@
+import pytest
+
+import admission
+from admission import SHED_GLOBAL, SHED_GROUP, SHED_USER, AdmissionController, estimate_sentence_count
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    return now
+
+
+def make_controller(**kwargs):
+    params = dict(user_burst=4, user_rate=1, group_burst=10, group_rate=2, max_in_flight=100)
+    params.update(kwargs)
+    return AdmissionController(**params)
+
+
+def test_user_bucket_drains_and_refills(clock):
+    controller = make_controller()
+    assert controller.try_admit("u1", None, 3) is None
+    assert controller.try_admit("u1", None, 2) == SHED_USER
+    # Other users have their own bucket
+    assert controller.try_admit("u2", None, 2) is None
+    clock[0] += 1
+    assert controller.try_admit("u1", None, 2) is None
+    # Refill stops at the burst size
+    clock[0] += 100
+    assert controller.user_buckets.get("u1", clock[0]).tokens == 4
+
+
+def test_group_bucket_is_shared_by_its_users(clock):
+    controller = make_controller(group_burst=5)
+    assert controller.try_admit("u1", "g1", 3) is None
+    assert controller.try_admit("u2", "g1", 3) == SHED_GROUP
+    # A shed message costs nothing
+    assert controller.user_buckets.get("u2", clock[0]).tokens == 4
+    assert controller.try_admit("u2", "g2", 3) is None
+
+
+def test_oversized_message_is_admitted_by_a_full_bucket(clock):
+    controller = make_controller()
+    assert controller.try_admit("u1", None, 9) is None
+    assert controller.user_buckets.get("u1", clock[0]).tokens == 0
+    assert controller.try_admit("u1", None, 9) == SHED_USER
+    clock[0] += 4
+    assert controller.try_admit("u1", None, 9) is None
+
+
+def test_global_limit_and_release(clock):
+    controller = make_controller(user_burst=100, max_in_flight=5)
+    # An idle controller admits a message larger than the whole budget
+    assert controller.try_admit("u1", None, 7) is None
+    assert controller.try_admit("u2", None, 1) == SHED_GLOBAL
+    controller.release(7)
+    assert controller.try_admit("u2", None, 3) is None
+    assert controller.try_admit("u3", None, 2) is None
+    assert controller.try_admit("u4", None, 1) == SHED_GLOBAL
+    assert controller.snapshot() == {
+        "admitted": 3,
+        "admitted_sentences": 12,
+        "shed_global": 2,
+        "in_flight_sentences": 5,
+    }
+
+
+def test_overloaded(clock):
+    assert not make_controller().overloaded()
+    controller = make_controller(degrade_in_flight=2)
+    controller.try_admit("u1", None, 2)
+    assert not controller.overloaded()
+    controller.try_admit("u2", None, 1)
+    assert controller.overloaded()
+    controller.release(1)
+    assert not controller.overloaded()
+
+
+def test_least_recently_used_bucket_is_evicted(clock):
+    controller = make_controller(max_buckets=2)
+    controller.try_admit("u1", None, 4)
+    controller.try_admit("u2", None, 1)
+    controller.try_admit("u1", None, 0)
+    controller.try_admit("u3", None, 1)
+    assert list(controller.user_buckets.buckets) == ["u1", "u3"]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Hello there.", 1),
+    ("Hello there. How are you? Fine!", 3),
+    ("Version 1.2 is out", 1),
+    ("", 1),
+    ("see https://example.com/a. ok", 1),
+    ("好喔 那你很厲害誒", 2),
+    ("好喔，那你很厲害誒。明天見！", 3),
+    ("看這個 https://example.com/a 好笑", 2),
+])
+def test_estimate_sentence_count(text, expected):
+    assert estimate_sentence_count(text) == expected
+
+
+def test_estimate_sentence_count_with_coalescing():
+    text = "好 我 知道 了 明天 見"
+    assert estimate_sentence_count(text) == 6
+    # "好 我 知道" and "了 明天 見", the short "見" joining the clause before it
+    assert estimate_sentence_count(text, min_clause_length=4) == 2
+    assert estimate_sentence_count(text, min_clause_length=30, max_clause_length=30) == 1
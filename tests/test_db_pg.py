@@ -0,0 +1,127 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlparse
+
+import pytest
+
+from db_common import feedback_partition_name, month_start, next_month_start
+
+# The unpartitioned table the bot used before partitioning, and the migration in deploy.md
+LEGACY_FEEDBACK_DDL = """
+    CREATE TABLE feedback (
+        id SERIAL PRIMARY KEY,
+        input TEXT NOT NULL,
+        output TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        create_time TIMESTAMP NOT NULL,
+        preference INTEGER
+    )
+"""
+MIGRATION = """
+    ALTER TABLE feedback RENAME TO feedback_legacy;
+    ALTER TABLE feedback_legacy ALTER COLUMN id DROP DEFAULT, ALTER COLUMN id TYPE BIGINT;
+    ALTER TABLE feedback_legacy DROP CONSTRAINT feedback_pkey, ADD PRIMARY KEY (id, create_time);
+    CREATE TABLE feedback (LIKE feedback_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (create_time);
+    ALTER TABLE feedback ADD PRIMARY KEY (id, create_time);
+    ALTER TABLE feedback ATTACH PARTITION feedback_legacy FOR VALUES FROM (MINVALUE) TO ('{until}');
+"""
+
+
+async def open_migrated(dsn: str, schema: str, until: datetime, legacy_rows: list[datetime]):
+    """Creates a pre-partitioning feedback table in `schema`, migrates it, and starts the app's Database on it."""
+    import asyncpg
+    from db_pg import Database
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f"CREATE SCHEMA {schema}")
+        await conn.execute(f"SET search_path TO {schema}")
+        await conn.execute(LEGACY_FEEDBACK_DDL)
+        await conn.executemany(
+            "INSERT INTO feedback (input, output, user_id, create_time) VALUES ('hi', '👋', 'u', $1)", [(t,) for t in legacy_rows])
+        async with conn.transaction():
+            await conn.execute(MIGRATION.format(until=until.isoformat()))
+    finally:
+        await conn.close()
+    separator = '&' if urlparse(dsn).query else '?'
+    return await Database.create_and_connect(dsn=f"{dsn}{separator}{urlencode({'search_path': schema})}")
+
+
+async def partition_bounds(db) -> dict[str, str]:
+    async with db.pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+            FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = 'feedback'::regclass
+        """)
+    return {row['name']: row['bound'] for row in rows}
+
+
+def run_migrated(dsn: str, until: datetime, check, legacy_rows: list[datetime] = ()):
+    import asyncpg
+
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+
+    async def run():
+        db = await open_migrated(dsn, schema, until, list(legacy_rows))
+        try:
+            await check(db)
+        finally:
+            await db.close()
+            conn = await asyncpg.connect(dsn)
+            try:
+                await conn.execute(f"DROP SCHEMA {schema} CASCADE")
+            finally:
+                await conn.close()
+
+    asyncio.run(run())
+
+
+def test_legacy_partition_covering_this_month(pg_dsn):
+    now = datetime.now()
+    until = next_month_start(now)
+
+    async def check(db):
+        bounds = await partition_bounds(db)
+        # This month is already covered by feedback_legacy; next month starts where it ends
+        assert feedback_partition_name(now) not in bounds
+        assert until.strftime("%Y-%m-%d") in bounds[feedback_partition_name(until)]
+
+        await db.ensure_feedback_partitions(now)
+        feedback_id = await db.allocate_feedback_id()
+        await db.insert_feedback(feedback_id, "好喔", "👌", "u", now)
+        await db.feedback_batcher.flush()
+        async with db.pool.acquire() as conn:
+            assert await conn.fetchval("SELECT count(*) FROM feedback_legacy") == 2
+
+    run_migrated(pg_dsn, until, check, legacy_rows=[now - timedelta(days=400)])
+
+
+def test_legacy_partition_ending_mid_month(pg_dsn):
+    now = datetime.now()
+    until = month_start(now) + timedelta(days=10)
+
+    async def check(db):
+        bounds = await partition_bounds(db)
+        assert until.strftime("%Y-%m-%d") in bounds[feedback_partition_name(now)]
+        assert feedback_partition_name(next_month_start(now)) in bounds
+
+    run_migrated(pg_dsn, until, check)
+
+
+def test_legacy_partition_is_compacted(pg_dsn, tmp_path):
+    pytest.importorskip("pyarrow")
+    from feedback_compaction import compact_feedback
+
+    now = datetime.now()
+    old = now - timedelta(days=400)
+
+    async def check(db):
+        assert [name for name, _ in await db.list_feedback_partitions()][0] == "feedback_legacy"
+        compacted = await compact_feedback(db, retention_days=90, export_dir=str(tmp_path), now=now)
+        assert compacted == ["feedback_legacy"]
+        assert "feedback_legacy" not in await partition_bounds(db)
+        assert len(list(tmp_path.glob("feedback_legacy_until_*.parquet"))) == 1
+
+    run_migrated(pg_dsn, month_start(now), check, legacy_rows=[old])
@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip("emoji")
+
+from emoji_lexicon import EmojiLexicon, LexiconBuilder, split_reply, write_lexicon, lexicon_key
+
+
+def test_split_cjk_reply():
+    assert split_reply("好喔 那你很厲害誒", "好喔👌 那你很厲害誒😂😂") == [("好喔", "👌"), ("那你很厲害誒", "😂😂")]
+
+
+def test_split_english_reply():
+    # The English tokenizer drops the whitespace between sentences
+    assert split_reply("I love you. See you!", "I love you❤.See you👋!") == [("I love you", "❤"), ("See you", "👋")]
+
+
+def test_split_coalesced_clauses():
+    assert split_reply("好 我 知道了，明天見", "好 我 知道了😀，明天見👋") == [("好 我 知道了", "😀"), ("明天見", "👋")]
+
+
+def test_sentence_without_emoji_is_skipped():
+    # With lexicon_only, uncovered sentences come back bare
+    assert split_reply("好喔 那你很厲害誒", "好喔👌 那你很厲害誒") == [("好喔", "👌")]
+
+
+def test_urls_are_not_part_of_the_reply():
+    assert split_reply("看這個 https://example.com/a 好笑", "看這個😀  好笑😂") == [("看這個", "😀"), ("好笑", "😂")]
+
+
+def test_reply_that_is_not_the_input_yields_nothing():
+    assert split_reply("一 二 三", "太長了啦❗️ 你輸入了3句 目前限制2句話") == []
+
+
+def test_input_with_emoji_yields_nothing():
+    assert split_reply("好喔😀", "好喔😀👌") == []
+
+
+def test_lexicon_round_trip(tmp_path):
+    path = str(tmp_path / "lexicon.bin")
+    entries = {lexicon_key(f"句子{i}"): "😀" * (i % 3 + 1) for i in range(100)}
+    write_lexicon(path, entries)
+    lexicon = EmojiLexicon.open(path)
+    try:
+        assert len(lexicon) == 100
+        assert lexicon.get("句子7") == "😀😀"
+        assert lexicon.get(" 句子7 ") == "😀😀"
+        assert lexicon.get("沒有這句") is None
+        assert lexicon.stats() == {"entries": 100, "hits": 2, "misses": 1}
+    finally:
+        lexicon.close()
+
+
+def test_builder_weighs_preferences_and_drops_low_scores():
+    builder = LexiconBuilder(max_sentence_length=20, min_score=3, max_entries=10)
+    for _ in range(3):
+        builder.add_row("笑死", "笑死😂", None)
+    builder.add_row("笑死", "笑死🤣", 1)
+    builder.add_row("晚安", "晚安🌙", None)
+    builder.add_row("好喔", "好喔👌", 1)
+    builder.add_row("好喔", "好喔👌", -1)
+    assert builder.rows == 7
+    assert builder.entries() == {lexicon_key("笑死"): "🤣"}
+
+
+def test_builder_skips_long_sentences():
+    builder = LexiconBuilder(max_sentence_length=4, min_score=1)
+    builder.add_row("這句話太長了", "這句話太長了😂", 1)
+    assert builder.entries() == {}
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+try:
+    from emojilm_openai import EmojiLmBase
+except (ImportError, ValueError) as e:
+    pytest.skip(f"emojilm_openai needs fastText and lid.176.ftz: {e}", allow_module_level=True)
+
+
+class EchoEmojiLm(EmojiLmBase):
+    """Answers every sentence with 😀 and records what it was asked."""
+
+    def __init__(self, **kwargs):
+        super().__init__(sentence_limit=3, **kwargs)
+        self.queries = []
+
+    async def query(self, input_text):
+        self.queries.append(input_text)
+        return "😀"
+
+
+class FixedLexicon:
+    def __init__(self, entries):
+        self.entries = entries
+
+    def get(self, sentence):
+        return self.entries.get(sentence)
+
+
+def test_emojis_follow_each_sentence():
+    emojilm = EchoEmojiLm()
+    output, emoji_set = asyncio.run(emojilm.generate("好喔 那你很厲害誒"))
+    assert output == "好喔😀 那你很厲害誒😀"
+    assert emoji_set == {"😀"}
+    assert emojilm.queries == ["好喔", "那你很厲害誒"]
+
+
+def test_lexicon_answers_before_the_backend():
+    emojilm = EchoEmojiLm(lexicon=FixedLexicon({"好喔": "👌"}))
+    output, _ = asyncio.run(emojilm.generate("好喔 那你很厲害誒"))
+    assert output == "好喔👌 那你很厲害誒😀"
+    assert emojilm.queries == ["那你很厲害誒"]
+
+
+def test_lexicon_only_leaves_uncovered_sentences_bare():
+    emojilm = EchoEmojiLm(lexicon=FixedLexicon({"好喔": "👌"}))
+    output, _ = asyncio.run(emojilm.generate("好喔 那你很厲害誒", lexicon_only=True))
+    assert output == "好喔👌 那你很厲害誒"
+    assert emojilm.queries == []
+
+
+def test_too_many_sentences_are_refused():
+    emojilm = EchoEmojiLm()
+    output, emoji_set = asyncio.run(emojilm.generate("一 二 三 四 五"))
+    assert "目前限制3句話" in output
+    assert emoji_set == []
+    assert emojilm.queries == []
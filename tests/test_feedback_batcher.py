@@ -0,0 +1,173 @@
+import asyncio
+from datetime import datetime
+
+from db_common import FeedbackBatcher, FeedbackIdAllocator
+
+NOW = datetime(2025, 7, 1, 12)
+
+
+class FakeStore:
+    """Records written rows and preferences; `gate` holds writes open, `fail` ids make a write fail."""
+
+    def __init__(self):
+        self.rows: dict[int, list] = {}
+        self.write_calls = 0
+        self.gate: asyncio.Event = None
+        self.writing = asyncio.Event()
+        self.fail: set[int] = set()
+        self.fail_times = 0
+
+    async def write_rows(self, rows):
+        self.write_calls += 1
+        self.writing.set()
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.fail_times:
+            self.fail_times -= 1
+            raise ConnectionError("connection reset")
+        if any(row[0] in self.fail for row in rows):
+            raise ValueError("bad row")
+        for row in rows:
+            self.rows[row[0]] = list(row)
+
+    async def update_preferences(self, preferences):
+        for feedback_id, preference in preferences:
+            if feedback_id in self.rows:
+                self.rows[feedback_id][5] = preference
+
+
+def make_batcher(store, **kwargs):
+    # A long interval, so only the tests flush
+    return FeedbackBatcher(store.write_rows, store.update_preferences, flush_interval=60, **kwargs)
+
+
+def test_rows_are_written_in_one_batch():
+    async def run():
+        store = FakeStore()
+        batcher = make_batcher(store)
+        for i in range(3):
+            batcher.add(i, "好喔", "👌", "u", NOW)
+        await batcher.flush()
+        await batcher.close()
+        return store
+
+    store = asyncio.run(run())
+    assert sorted(store.rows) == [0, 1, 2]
+    assert store.write_calls == 1
+
+
+def test_full_batch_wakes_the_flush_loop():
+    async def run():
+        store = FakeStore()
+        batcher = make_batcher(store, max_batch_size=2)
+        batcher.add(0, "a", "😀", "u", NOW)
+        batcher.add(1, "b", "😀", "u", NOW)
+        await asyncio.wait_for(store.writing.wait(), timeout=1)
+        await batcher.close()
+        return store
+
+    assert sorted(asyncio.run(run()).rows) == [0, 1]
+
+
+def test_preference_before_flush_is_written_with_the_row():
+    async def run():
+        store = FakeStore()
+        batcher = make_batcher(store)
+        batcher.add(1, "好喔", "👌", "u", NOW)
+        assert batcher.set_preference(1, 1)
+        await batcher.close()
+        return store
+
+    assert asyncio.run(run()).rows[1][5] == 1
+
+
+def test_preference_during_flush_is_applied_after_the_batch():
+    async def run():
+        store = FakeStore()
+        store.gate = asyncio.Event()
+        batcher = make_batcher(store)
+        batcher.add(1, "好喔", "👌", "u", NOW)
+        flush = asyncio.create_task(batcher.flush())
+        await store.writing.wait()
+        assert batcher.set_preference(1, -1)
+        store.gate.set()
+        await flush
+        # Written now, so the caller updates the database itself
+        assert not batcher.set_preference(1, 1)
+        await batcher.close()
+        return store
+
+    assert asyncio.run(run()).rows[1][5] == -1
+
+
+def test_close_finishes_the_flush_in_progress_and_writes_the_rest():
+    async def run():
+        store = FakeStore()
+        store.gate = asyncio.Event()
+        batcher = make_batcher(store)
+        batcher.add(1, "a", "😀", "u", NOW)
+        flush = asyncio.create_task(batcher.flush())
+        await store.writing.wait()
+        batcher.add(2, "b", "😀", "u", NOW)
+        close = asyncio.create_task(batcher.close())
+        await asyncio.sleep(0)
+        store.gate.set()
+        await asyncio.gather(flush, close)
+        return store
+
+    assert sorted(asyncio.run(run()).rows) == [1, 2]
+
+
+def test_failed_batch_is_retried_with_late_preferences():
+    async def run():
+        store = FakeStore()
+        store.gate = asyncio.Event()
+        store.fail_times = 1
+        batcher = make_batcher(store)
+        batcher.add(1, "好喔", "👌", "u", NOW)
+        flush = asyncio.create_task(batcher.flush())
+        await store.writing.wait()
+        batcher.set_preference(1, 1)
+        store.gate.set()
+        await flush
+        assert store.rows == {}
+        await batcher.flush()
+        await batcher.close()
+        return store
+
+    store = asyncio.run(run())
+    assert store.rows[1][5] == 1
+    assert store.write_calls == 2
+
+
+def test_bad_row_only_loses_itself():
+    async def run():
+        store = FakeStore()
+        store.fail = {2}
+        batcher = make_batcher(store, max_attempts=2)
+        for i in range(1, 4):
+            batcher.add(i, "好喔", "👌", "u", NOW)
+        await batcher.close()
+        return store
+
+    store = asyncio.run(run())
+    assert sorted(store.rows) == [1, 3]
+    # Two batch attempts, then one write per row
+    assert store.write_calls == 2 + 3
+
+
+def test_id_allocator_reserves_one_block_per_block_size():
+    reserved = []
+
+    async def reserve_block(block_size):
+        await asyncio.sleep(0)
+        reserved.append(block_size)
+        return 100 * len(reserved)
+
+    async def run():
+        allocator = FeedbackIdAllocator(reserve_block, block_size=3)
+        return await asyncio.gather(*(allocator.allocate() for _ in range(7)))
+
+    ids = asyncio.run(run())
+    assert ids == [100, 101, 102, 200, 201, 202, 300]
+    assert reserved == [3, 3, 3]
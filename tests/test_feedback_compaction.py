@@ -0,0 +1,56 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from feedback_compaction import compact_feedback
+
+ROWS = [(i, "好喔", "👌", "u", datetime(2025, 1, 1, 12), None) for i in range(1, 11)]
+
+
+class FakeDatabase:
+    """One expired partition served in chunks; `stall` blocks the second chunk until cancelled."""
+
+    def __init__(self, stall: bool = False):
+        self.stall = stall
+        self.dropped = []
+        self.reading = asyncio.Event()
+
+    async def list_feedback_partitions(self):
+        return [("feedback_p2025_01", datetime(2025, 2, 1))]
+
+    async def read_feedback_partition(self, name, after_id, limit):
+        if after_id and self.stall:
+            self.reading.set()
+            await asyncio.Event().wait()
+        return [row for row in ROWS if row[0] > after_id][:5]
+
+    async def drop_feedback_partition(self, name):
+        self.dropped.append(name)
+
+
+def test_expired_partition_is_exported_and_dropped(tmp_path):
+    import pyarrow.parquet as pq
+
+    db = FakeDatabase()
+    compacted = asyncio.run(compact_feedback(db, 90, str(tmp_path), now=datetime(2025, 6, 1)))
+    assert compacted == db.dropped == ["feedback_p2025_01"]
+    [path] = tmp_path.iterdir()
+    assert pq.read_table(path).column("id").to_pylist() == list(range(1, 11))
+
+
+def test_cancelled_export_leaves_no_file_and_keeps_the_partition(tmp_path):
+    async def run():
+        db = FakeDatabase(stall=True)
+        task = asyncio.create_task(compact_feedback(db, 90, str(tmp_path), now=datetime(2025, 6, 1)))
+        await db.reading.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return db
+
+    db = asyncio.run(run())
+    assert db.dropped == []
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+from llama_decoder import LlamaBatchDecoder
+
+PROMPTS = ["笑死", "好喔 那你很厲害誒", "I love you", "今天天氣很好", "晚安 明天見", "不要 拜託 我錯了"]
+
+
+@pytest.fixture(scope="module")
+def decoder(gguf_path):
+    # Greedy, so a prompt's completion does not depend on what else is in the batch
+    decoder = LlamaBatchDecoder(gguf_path, n_seq_max=4, n_ctx_per_seq=64, n_threads=1, temperature=0.0)
+    yield decoder
+    decoder.close()
+
+
+def run_to_completion(decoder, prompts):
+    queued = list(enumerate(prompts))
+    outputs = {}
+    steps = 0
+    while queued or not decoder.idle:
+        admitted, queued = queued[:decoder.free_slots], queued[decoder.free_slots:]
+        outputs.update(decoder.step(admitted))
+        steps += 1
+    return [outputs[i] for i in range(len(prompts))], steps
+
+
+def test_batched_outputs_match_one_at_a_time(decoder):
+    alone = [run_to_completion(decoder, [prompt])[0][0] for prompt in PROMPTS]
+    batched, _ = run_to_completion(decoder, PROMPTS)
+    assert batched == alone
+
+
+def test_sequences_are_released(decoder):
+    run_to_completion(decoder, PROMPTS)
+    assert decoder.idle
+    assert decoder.free_slots == 4
+
+
+def test_completions_end_before_stop_strings(decoder):
+    outputs, steps = run_to_completion(decoder, PROMPTS)
+    for output in outputs:
+        assert not any(stop in output for stop in decoder.stop)
+    # Two waves of at most max_tokens steps each
+    assert steps <= 2 * decoder.max_tokens
+
+
+def test_late_prompt_does_not_wait_for_the_batch(decoder):
+    decoder.step([(i, prompt) for i, prompt in enumerate(PROMPTS[:3])])
+    finished_at = None
+    for step in range(1, 2 * decoder.max_tokens):
+        finished = dict(decoder.step([(99, "好")] if step == 1 else []))
+        if 99 in finished:
+            finished_at = step
+            break
+    assert finished_at is not None and finished_at <= decoder.max_tokens
+    run_to_completion(decoder, [])
+
+
+def test_long_prompt_is_truncated(decoder):
+    outputs, _ = run_to_completion(decoder, ["哈" * 500])
+    assert isinstance(outputs[0], str)
+
+
+def test_too_many_prompts_for_free_sequences(decoder):
+    with pytest.raises(ValueError):
+        decoder.step([(i, "好") for i in range(5)])
+
+
+def test_backend_generates_concurrently(gguf_path):
+    try:
+        from emojilm_llama_cpp import EmojiLmLlamaCpp
+    except (ImportError, ValueError) as e:
+        pytest.skip(f"emojilm_openai needs fastText and lid.176.ftz: {e}")
+
+    async def run():
+        emojilm = await EmojiLmLlamaCpp.create(gguf_path, sentence_limit=100, max_batch_size=4, n_ctx_per_seq=64)
+        try:
+            results = await asyncio.gather(*(emojilm.query(f"{prompt} {i}") for i, prompt in enumerate(PROMPTS * 4)))
+        finally:
+            await emojilm.close()
+        return results
+
+    assert len(asyncio.run(run())) == len(PROMPTS) * 4
+
+
+def test_backend_requires_a_model_path():
+    try:
+        from emojilm_llama_cpp import EmojiLmLlamaCpp
+    except (ImportError, ValueError) as e:
+        pytest.skip(f"emojilm_openai needs fastText and lid.176.ftz: {e}")
+
+    with pytest.raises(ValueError):
+        asyncio.run(EmojiLmLlamaCpp.create(None, sentence_limit=100))
@@ -0,0 +1,84 @@
+import pytest
+
+from near_duplicate import NearDuplicateIndex, canonicalize, count_negations
+
+
+@pytest.fixture
+def index():
+    return NearDuplicateIndex(threshold=0.75)
+
+
+@pytest.mark.parametrize("answered, variant", [
+    ("好喔", "好喔喔"),
+    ("好啊", "好啊啦"),
+    ("今天好熱", "今天好熱喔"),
+    ("哈哈哈哈", "哈哈哈"),
+    ("ＯＫ啦", "ok"),
+    ("你很厲害誒", "你很厲害!!"),
+    ("Good night", "good night!!!"),
+])
+def test_trivial_variants_reuse_the_emoji(index, answered, variant):
+    index.insert(answered, "👍")
+    assert index.lookup(variant) == "👍"
+
+
+@pytest.mark.parametrize("answered, negated", [
+    ("好喔", "不好喔"),
+    ("我喜歡你", "我不喜歡你"),
+    ("這部電影我很喜歡看", "這部電影我不很喜歡看"),
+    ("有看到", "沒有看到"),
+    ("I like it", "I don't like it"),
+    ("I like it", "I dont like it"),
+])
+def test_negations_never_match(index, answered, negated):
+    index.insert(answered, "😍")
+    assert index.lookup(negated) is None
+
+
+@pytest.mark.parametrize("answered, other", [
+    ("晚安", "早安"),
+    ("我愛你", "我恨你"),
+    ("笑死", "笑死我了"),
+])
+def test_different_sentences_do_not_match(index, answered, other):
+    index.insert(answered, "😂")
+    assert index.lookup(other) is None
+
+
+def test_canonicalize():
+    assert canonicalize("ＯＫ啦！！") == "ok"
+    assert canonicalize("哈哈哈哈哈") == "哈哈"
+    # A particle on its own is the whole sentence, not a trailing particle
+    assert canonicalize("喔") == "喔"
+    assert count_negations("我不是不喜歡") == 2
+
+
+def test_long_sentences_skip_the_index():
+    index = NearDuplicateIndex(threshold=0.75, max_length=10)
+    sentence = "這句話很長很長很長很長很長"
+    index.insert(sentence, "📏")
+    assert index.lookup(sentence) is None
+    assert index.stats()["entries"] == 0
+
+
+def test_punctuation_only_is_not_indexed(index):
+    index.insert("！！！", "❗")
+    assert index.lookup("???") is None
+    assert index.stats()["entries"] == 0
+
+
+def test_same_sentence_keeps_one_entry_with_the_newest_answer(index):
+    index.insert("好喔", "👌")
+    index.insert("好喔！", "🙆")
+    assert index.stats()["entries"] == 1
+    assert index.lookup("好喔") == "🙆"
+
+
+def test_oldest_entries_are_evicted():
+    index = NearDuplicateIndex(threshold=0.75, max_entries=2)
+    for sentence in ("晚安", "早餐", "下雨"):
+        index.insert(sentence, "🌙")
+    assert index.lookup("晚安") is None
+    assert index.lookup("下雨") == "🌙"
+    assert index.stats()["evictions"] == 1
+    assert sum(len(bucket) for buckets in index.buckets for bucket in buckets.values()) == 2 * index.bands
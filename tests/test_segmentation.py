@@ -0,0 +1,50 @@
+import pytest
+
+from segmentation import coalesce_fragments, split_cjk
+
+TEXTS = [
+    "好 我 知道 了 明天 見",
+    "好喔，那你很厲害誒。明天見！",
+    "哈哈 笑死 你真的很好笑欸 我不行了 晚安",
+    "  今天天氣很好，我們去公園散步吧 好 ",
+    "嗯\n好\n掰",
+    "這是一句很長很長很長很長很長很長很長很長的話，短",
+]
+
+
+def rebuild(sentence_list, delimiter_list):
+    return "".join(sentence + delimiter for sentence, delimiter in zip(sentence_list, delimiter_list))
+
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("min_length, max_length", [(0, 20), (4, 20), (6, 10), (30, 30)])
+def test_coalesce_round_trip(text, min_length, max_length):
+    sentence_list, delimiter_list = split_cjk(text)
+    clauses, clause_delimiters = coalesce_fragments(sentence_list, delimiter_list, min_length, max_length)
+    assert len(clauses) == len(clause_delimiters)
+    assert rebuild(clauses, clause_delimiters) == rebuild(sentence_list, delimiter_list)
+
+
+def test_min_length_zero_keeps_fragments():
+    sentence_list, delimiter_list = split_cjk("好 我 知道 了")
+    assert coalesce_fragments(sentence_list, delimiter_list, 0) == (sentence_list, delimiter_list)
+
+
+def test_merges_short_fragments_up_to_max_length():
+    sentence_list, delimiter_list = split_cjk("好 我 知道 了 明天 見")
+    assert coalesce_fragments(sentence_list, delimiter_list, 4, 20) == (["好 我 知道", "了 明天 見"], [" ", ""])
+    clauses, _ = coalesce_fragments(sentence_list, delimiter_list, 30, 5)
+    assert all(len(clause) <= 5 for clause in clauses)
+
+
+def test_never_merges_across_sentence_ends():
+    sentence_list, delimiter_list = split_cjk("好。我！知道？了\n嗯")
+    assert coalesce_fragments(sentence_list, delimiter_list, 10) == (sentence_list, delimiter_list)
+
+
+def test_short_trailing_fragment_joins_the_clause_before_it():
+    sentence_list, delimiter_list = split_cjk("今天天氣很好，短")
+    assert coalesce_fragments(sentence_list, delimiter_list, 4) == (["今天天氣很好，短"], [""])
+    # Unless the clause before it ends a sentence
+    sentence_list, delimiter_list = split_cjk("今天天氣很好。短")
+    assert coalesce_fragments(sentence_list, delimiter_list, 4) == (["今天天氣很好", "短"], ["。", ""])
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+from sentence_cache import ENTRY_OVERHEAD, SentenceCache, sentence_key
+
+
+def test_bytes_stay_within_the_bound():
+    cache = SentenceCache(64 * 1024)
+    for i in range(5000):
+        cache.put(f"句子{i}", "😀" * (i % 7 + 1))
+    stats = cache.stats()
+    assert stats["bytes"] <= stats["max_bytes"]
+    assert stats["evictions"] + stats["rejections"] > 0
+
+
+def test_oversized_value_is_not_admitted():
+    cache = SentenceCache(ENTRY_OVERHEAD * 8)
+    cache.put("長", "😀" * 1000)
+    for i in range(8):
+        cache.put(f"擠{i}", "😀")
+    assert cache.get("長") is None
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+
+def test_frequent_phrases_survive_a_one_off_flood():
+    cache = SentenceCache(32 * 1024)
+    frequent = [f"常用{i}" for i in range(20)]
+    for _ in range(5):
+        for phrase in frequent:
+            if cache.get(phrase) is None:
+                cache.put(phrase, "👍")
+    for i in range(3000):
+        cache.put(f"只出現一次的句子{i}", "🙂")
+    assert sum(cache.get(phrase) is not None for phrase in frequent) >= 18
+
+
+def test_keys_are_normalized():
+    cache = SentenceCache(1024 * 1024)
+    cache.put("好喔  好", "👌")
+    assert cache.get(" 好喔 好") == "👌"
+    assert cache.get("ｈｉ") is None
+    cache.put("hi", "👋")
+    assert cache.get("ｈｉ") == "👋"
+    assert cache.get("hi", namespace="fast") is None
+
+
+def test_peek_miss_is_not_counted():
+    cache = SentenceCache(1024 * 1024)
+    key = sentence_key("好喔", "quality")
+    assert cache.get("好喔", namespace="quality", count_miss=False) is None
+    assert cache.sketch.frequency(key) == 0
+    assert cache.stats()["misses"] == 0
+
+    cache.put("好喔", "👌", namespace="quality")
+    assert cache.get("好喔", namespace="quality", count_miss=False) == "👌"
+    assert cache.sketch.frequency(key) == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_concurrent_loads_are_coalesced():
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "😂"
+
+    async def run():
+        cache = SentenceCache(1024 * 1024)
+        results = await asyncio.gather(*(cache.get_or_load("笑死", load) for _ in range(5)))
+        return cache, results
+
+    cache, results = asyncio.run(run())
+    assert results == ["😂"] * 5
+    assert len(calls) == 1
+    assert cache.stats()["coalesced"] == 4
+    assert cache.get("笑死") == "😂"
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_load():
+    async def run():
+        cache = SentenceCache(1024 * 1024)
+        release = asyncio.Event()
+
+        async def load():
+            await release.wait()
+            return "😂"
+
+        first = asyncio.create_task(cache.get_or_load("笑死", load))
+        second = asyncio.create_task(cache.get_or_load("笑死", load))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return cache, await second
+
+    cache, result = asyncio.run(run())
+    assert result == "😂"
+    assert cache.get("笑死") == "😂"
+    assert not cache.in_flight
+
+
+def test_failed_load_is_not_cached():
+    async def fail():
+        raise ConnectionError("backend down")
+
+    async def succeed():
+        return "😂"
+
+    async def run():
+        cache = SentenceCache(1024 * 1024)
+        with pytest.raises(ConnectionError):
+            await cache.get_or_load("笑死", fail)
+        return await cache.get_or_load("笑死", succeed)
+
+    assert asyncio.run(run()) == "😂"
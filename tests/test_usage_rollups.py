@@ -0,0 +1,103 @@
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from urllib.parse import urlencode, urlparse
+
+import pytest
+
+from db_common import USAGE_ALL_CHATS, vote_counters
+
+CREATED = datetime(2025, 7, 1, 23, 59)
+
+
+def test_vote_counters():
+    assert vote_counters(None, 1) == {"likes": 1}
+    assert vote_counters(None, -1) == {"dislikes": 1}
+    assert vote_counters(1, 1) == {}
+    assert vote_counters(1, -1) == {"dislikes": 1, "likes": -1}
+
+
+@asynccontextmanager
+async def sqlite_db(tmp_path):
+    from db_sqlite import Database
+
+    db = await Database.create_and_connect(dsn=str(tmp_path / "emojilm.db"))
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+@asynccontextmanager
+async def pg_db(pg_dsn):
+    import asyncpg
+    from db_pg import Database
+
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    conn = await asyncpg.connect(pg_dsn)
+    try:
+        await conn.execute(f"CREATE SCHEMA {schema}")
+        separator = '&' if urlparse(pg_dsn).query else '?'
+        db = await Database.create_and_connect(dsn=f"{pg_dsn}{separator}{urlencode({'search_path': schema})}")
+        try:
+            yield db
+        finally:
+            await db.close()
+    finally:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        await conn.close()
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def open_db(request, tmp_path):
+    if request.param == "sqlite":
+        return lambda: sqlite_db(tmp_path)
+    pg_dsn = request.getfixturevalue("pg_dsn")
+    return lambda: pg_db(pg_dsn)
+
+
+def run_with_db(open_db, check):
+    async def run():
+        async with open_db() as db:
+            await check(db)
+
+    asyncio.run(run())
+
+
+async def add_feedback(db, written: bool) -> int:
+    feedback_id = await db.allocate_feedback_id()
+    await db.insert_feedback(feedback_id, "好喔", "好喔👌", "u1", CREATED)
+    if written:
+        await db.feedback_batcher.flush()
+    return feedback_id
+
+
+@pytest.mark.parametrize("written", [False, True], ids=["queued", "written"])
+def test_votes_roll_up_under_the_chat_and_the_feedback_day(open_db, written):
+    async def check(db):
+        feedback_id = await add_feedback(db, written)
+        await db.update_feedback_preference(feedback_id, 1, "group1")
+        # A redelivered postback
+        await db.update_feedback_preference(feedback_id, 1, "group1")
+        for chat_id in (USAGE_ALL_CHATS, "group1"):
+            usage = await db.get_usage_stats(CREATED.date(), chat_id)
+            assert (usage["likes"], usage["dislikes"]) == (1, 0)
+        assert (await db.get_usage_stats(date.today()))["likes"] == 0
+
+        await db.update_feedback_preference(feedback_id, -1, "group1")
+        await db.feedback_batcher.flush()
+        for chat_id in (USAGE_ALL_CHATS, "group1"):
+            usage = await db.get_usage_stats(CREATED.date(), chat_id)
+            assert (usage["likes"], usage["dislikes"]) == (0, 1)
+
+    run_with_db(open_db, check)
+
+
+def test_vote_from_a_user_chat_only_counts_in_the_totals(open_db):
+    async def check(db):
+        feedback_id = await add_feedback(db, written=True)
+        await db.update_feedback_preference(feedback_id, 1)
+        assert (await db.get_usage_stats(CREATED.date()))["likes"] == 1
+
+    run_with_db(open_db, check)
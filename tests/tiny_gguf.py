@@ -0,0 +1,65 @@
+'''
+Writes a tiny llama-architecture GGUF with random weights, so the in-process backend can be
+tested without downloading the EmojiLM weights. Its output is gibberish, but deterministic for
+a given seed.
+'''
+
+import numpy as np
+
+N_EMBD = 64
+N_HEAD = 4
+N_LAYER = 2
+N_FF = 128
+N_CTX = 2048
+# <unk>, <s>, </s>, a handful of pieces, then byte fallback tokens so any text can be tokenized
+PIECES = ["▁", "▁笑", "死", "好", "喔", "😂", "👍", "❤", "🥺", "🔥"]
+
+
+def write_tiny_gguf(path: str, seed: int = 0):
+    import gguf
+
+    rng = np.random.default_rng(seed)
+    tokens = ["<unk>", "<s>", "</s>"] + PIECES + [f"<0x{byte:02X}>" for byte in range(256)]
+    token_types = ([gguf.TokenType.UNKNOWN, gguf.TokenType.CONTROL, gguf.TokenType.CONTROL]
+                   + [gguf.TokenType.NORMAL] * len(PIECES) + [gguf.TokenType.BYTE] * 256)
+    scores = [0.0] * 3 + [-float(i) for i in range(len(PIECES))] + [-1000.0] * 256
+
+    writer = gguf.GGUFWriter(path, "llama")
+    writer.add_name("tiny-random-llama")
+    writer.add_context_length(N_CTX)
+    writer.add_embedding_length(N_EMBD)
+    writer.add_block_count(N_LAYER)
+    writer.add_feed_forward_length(N_FF)
+    writer.add_head_count(N_HEAD)
+    writer.add_head_count_kv(N_HEAD)
+    writer.add_rope_dimension_count(N_EMBD // N_HEAD)
+    writer.add_layer_norm_rms_eps(1e-5)
+    writer.add_file_type(gguf.LlamaFileType.ALL_F32)
+    writer.add_tokenizer_model("llama")
+    writer.add_token_list(tokens)
+    writer.add_token_scores(scores)
+    writer.add_token_types(token_types)
+    writer.add_bos_token_id(1)
+    writer.add_eos_token_id(2)
+    writer.add_unk_token_id(0)
+    writer.add_add_bos_token(True)
+
+    def weight(*shape):
+        return rng.normal(0, 0.5, shape).astype(np.float32)
+
+    writer.add_tensor("token_embd.weight", weight(len(tokens), N_EMBD))
+    for i in range(N_LAYER):
+        writer.add_tensor(f"blk.{i}.attn_norm.weight", np.ones(N_EMBD, dtype=np.float32))
+        for name in ("attn_q", "attn_k", "attn_v", "attn_output"):
+            writer.add_tensor(f"blk.{i}.{name}.weight", weight(N_EMBD, N_EMBD))
+        writer.add_tensor(f"blk.{i}.ffn_norm.weight", np.ones(N_EMBD, dtype=np.float32))
+        writer.add_tensor(f"blk.{i}.ffn_gate.weight", weight(N_FF, N_EMBD))
+        writer.add_tensor(f"blk.{i}.ffn_up.weight", weight(N_FF, N_EMBD))
+        writer.add_tensor(f"blk.{i}.ffn_down.weight", weight(N_EMBD, N_FF))
+    writer.add_tensor("output_norm.weight", np.ones(N_EMBD, dtype=np.float32))
+    writer.add_tensor("output.weight", weight(len(tokens), N_EMBD))
+
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()